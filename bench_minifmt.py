@@ -0,0 +1,73 @@
+"""Compare markup.minifmt with the rule-by-rule reference formatter.
+
+    python bench_minifmt.py [file ...]
+
+Without arguments this times a generated set of catalog-like descriptions;
+with arguments it times each file's contents as one description, e.g. text
+exported from Book.description. Every input is also checked for identical
+output before it is timed.
+"""
+import random
+import sys
+import timeit
+
+import markup
+
+WORDS = ("the a of and to in her his was that it with as for on at by from they "
+    "she he had but not what all were when we there can an your which their said "
+    "dragon ship empire night blood queen station colony witch heart storm shadow "
+    "city forest machine memory river ghost crown signal winter engine").split()
+
+MARKUP = [
+    "*%s*", "_%s_", "+%s+", "%s -- %s", "%s---%s", "[url:http://example.com/%s|%s]",
+    "[goto:chapter-%s|%s]", "http://www.example.com/%s/", "www.example.org/%s",
+    "[color:red|%s]", "%s & %s", "<%s>",
+]
+
+def sentence(rnd):
+    words = [rnd.choice(WORDS) for i in range(rnd.randint(6, 20))]
+    if rnd.random() < 0.3:
+        i = rnd.randrange(len(words))
+        pattern = rnd.choice(MARKUP)
+        words[i] = pattern % tuple(rnd.choice(WORDS) for n in range(pattern.count("%s")))
+    return " ".join(words).capitalize() + "."
+
+def description(rnd):
+    lines = []
+    for paragraph in range(rnd.randint(2, 8)):
+        kind = rnd.random()
+        if kind < 0.1:
+            lines.append("! " + sentence(rnd))
+        elif kind < 0.15:
+            lines.append("@center: " + sentence(rnd))
+        elif kind < 0.2:
+            lines.append("----")
+        lines.append(" ".join(sentence(rnd) for i in range(rnd.randint(2, 7))))
+        lines.append("")
+    return u"\n".join(lines)
+
+def main(args):
+    if args:
+        corpus = [open(name).read().decode("utf-8") for name in args]
+    else:
+        rnd = random.Random(1)
+        corpus = [description(rnd) for i in range(200)]
+
+    for text in corpus:
+        if markup.minifmt(text) != markup.minifmt_rules(text):
+            print "MISMATCH:", repr(text[:60])
+            return 1
+
+    size = sum(len(text) for text in corpus)
+    print "%d descriptions, %d characters" % (len(corpus), size)
+    results = []
+    for name in ("minifmt_rules", "minifmt"):
+        fmt = getattr(markup, name)
+        best = min(timeit.repeat(lambda: [fmt(text) for text in corpus], number=5, repeat=3)) / 5
+        results.append(best)
+        print "%-14s %8.2f ms per pass, %6.1f us per description" % (name, best * 1000, best * 1e6 / len(corpus))
+    print "speedup        %8.1fx" % (results[0] / results[1])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,108 @@
+"""Time SearchIndex over a generated catalog.
+
+    python bench_search.py [books]
+
+Builds an index of catalog-like books (100,000 by default), then reports how
+long building, saving, and loading it take, its size, and query latency for
+a mix of whole-word and prefix queries, both on a freshly loaded index and
+once its postings have been unpacked, and for repeated queries answered from
+the index's cache of recent results.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+import search
+
+SYLLABLES = ("ka lo mir an thel dor va si ren gal or une bri tas col eth fen ris "
+    "mor dan el ia ost vel quin ar").split()
+COMMON = ("dragon ship empire night blood queen station colony witch heart storm shadow "
+    "city forest machine memory river ghost crown signal winter engine").split()
+STOP = "the a of and to in her his was that it with as for on at by from they she he".split()
+NAMES = ("ann ben cora dale eve finn gwen hugo iris jack kate leo mia nora owen "
+    "pia quinn rosa sam tess uma vic wren xena yuri zoe").split()
+GENRES = ["Fantasy", "Science Fiction", "Horror", "Romance", "Young Adult", "Superhero", "Myths", "Erotica"]
+
+def vocabulary(rnd, size=50000):
+    words = set(COMMON)
+    while len(words) < size:
+        words.add("".join(rnd.choice(SYLLABLES) for i in range(rnd.randint(2, 4))))
+    words = sorted(words)
+    rnd.shuffle(words)
+    return COMMON + [w for w in words if w not in COMMON]
+
+def word(rnd, vocab):
+    # about a third stopwords, the rest roughly Zipf distributed
+    if rnd.random() < 0.35:
+        return rnd.choice(STOP)
+    return vocab[int(len(vocab) ** rnd.random()) - 1]
+
+def text(rnd, vocab, n):
+    return u" ".join(word(rnd, vocab) for i in range(n))
+
+def book(rnd, vocab):
+    return dict(
+        title=text(rnd, vocab, rnd.randint(1, 5)).title(),
+        authors=u"%s %s" % (rnd.choice(NAMES).title(), rnd.choice(vocab).title()),
+        genres=u" ".join(rnd.sample(GENRES, rnd.randint(1, 3))),
+        blurb=text(rnd, vocab, rnd.randint(15, 40)),
+        description=text(rnd, vocab, rnd.randint(100, 300)),
+    )
+
+QUERIES = [u"dragon", u"dragon queen", u"storm shadow witch", u"drag", u"queen st", u"fantasy dragon",
+    u"kalomir", u"thel", u"zoe", u"machine memory river ghost", u"the night", u"nothingmatches"]
+
+def timed(f):
+    start = time.time()
+    result = f()
+    return result, time.time() - start
+
+def latency(index, runs=3, cached=False):
+    times = []
+    if cached:
+        for query in QUERIES:
+            index.search(query, 24)
+    for run in range(runs):
+        for query in QUERIES:
+            if not cached:
+                index._results.clear()
+            result, seconds = timed(lambda: index.search(query, 24))
+            times.append(seconds)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.95)], times[-1]
+
+def main(args):
+    n = args and int(args[0]) or 100000
+    rnd = random.Random(1)
+    vocab = vocabulary(rnd)
+    books = [book(rnd, vocab) for i in range(n)]
+
+    index = search.SearchIndex()
+    def build():
+        for i, fields in enumerate(books):
+            index.add(i + 1, fields)
+    result, seconds = timed(build)
+    print "%d books indexed in %.1f s, %d words" % (n, seconds, len(index.words))
+
+    path = os.path.join(tempfile.mkdtemp(), "search.idx")
+    result, seconds = timed(lambda: index.save(path))
+    print "saved in %.2f s, %.1f MB" % (seconds, os.path.getsize(path) / 1e6)
+    loaded, seconds = timed(lambda: search.SearchIndex.load(path))
+    print "loaded in %.2f s" % seconds
+    os.remove(path)
+
+    p50, p95, worst = latency(loaded, runs=1)
+    print "first queries after loading: median %.1f ms, 95%% %.1f ms, worst %.1f ms" % (p50 * 1000, p95 * 1000, worst * 1000)
+    p50, p95, worst = latency(loaded)
+    print "queries:                     median %.1f ms, 95%% %.1f ms, worst %.1f ms" % (p50 * 1000, p95 * 1000, worst * 1000)
+    p50, p95, worst = latency(loaded, cached=True)
+    print "repeated queries:            median %.3f ms, 95%% %.3f ms, worst %.3f ms" % (p50 * 1000, p95 * 1000, worst * 1000)
+
+    result, seconds = timed(lambda: loaded.add(1, books[1]))
+    print "reindexing one book: %.1f ms" % (seconds * 1000)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
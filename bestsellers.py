@@ -0,0 +1,129 @@
+# bookstore bestsellers
+#
+# BookSales holds each book's ready purchases over sliding windows of 7, 30
+# and 90 days. A purchase is added to all three as it becomes ready (see
+# count_book_sale in bookstore.models); each new day, the purchases from the
+# day that leaves a window are taken back out. update_bestsellers(), run after
+# each batch of PayPal notifications and with the rollups, also ranks the
+# visible books overall and in each genre into Bestseller rows, which pages
+# read through the cache.
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F
+
+from bookstore.models import Book, Genre, Purchase, BookSales, Bestseller
+from bookstore.catalog import load_cards
+from bookstore.caching import depend_on, forget_tags
+from bookstore.reports import get_watermark, set_watermark
+
+from datetime import date, datetime, timedelta
+
+WINDOWS = (7, 30, 90)
+TOP_SIZE = 24
+BESTSELLER_CACHE_KEY = 'bookstore.bestsellers.%s.%s'
+BESTSELLER_CACHE_TIMEOUT = 60 * 60 * 24
+
+def _day_sales(day):
+    """Purchases that became ready on day, by book; review copies aren't sales"""
+    start = datetime.combine(day, datetime.min.time())
+    return Purchase.objects.filter(ready_date__gte=start, ready_date__lt=start + timedelta(days=1)) \
+        .exclude(transaction='V').values_list('publication__book').annotate(Count('pk')).order_by()
+
+@transaction.commit_on_success
+def rebuild_sales(today):
+    """Count every window again from the purchases"""
+    BookSales.objects.all().delete()
+    sales = {}
+    for days_ago in range(max(WINDOWS)):
+        for book, n in _day_sales(today - timedelta(days=days_ago)):
+            counts = sales.setdefault(book, dict((window, 0) for window in WINDOWS))
+            for window in WINDOWS:
+                if days_ago < window:
+                    counts[window] += n
+    for book, counts in sales.items():
+        BookSales.objects.create(book_id=book, **dict(('sales_%d' % window, n) for window, n in counts.items()))
+    set_watermark('bestsellers.day', today.isoformat())
+
+@transaction.commit_on_success
+def slide_windows(today):
+    """Take out the sales of days that have left each window since the last slide; return days slid"""
+    last = datetime.strptime(get_watermark('bestsellers.day'), "%Y-%m-%d").date()
+    days = (today - last).days
+    for d in range(1, days + 1):
+        for window in WINDOWS:
+            field = 'sales_%d' % window
+            for book, n in _day_sales(last + timedelta(days=d - window)):
+                BookSales.objects.filter(book=book).update(**{field: F(field) - n})
+    set_watermark('bestsellers.day', today.isoformat())
+    return days
+
+def rank(today):
+    """The bestseller lists as {(window, genre id or None): [(book id, sales)]}"""
+    sales = BookSales.objects.filter(book__visible=True, book__publish_date__lte=today)
+    genres = list(Genre.objects.filter(visible=True).values_list('pk', flat=True))
+    lists = {}
+    for window in WINDOWS:
+        field = 'sales_%d' % window
+        top = sales.filter(**{field + '__gt': 0}).order_by('-' + field, 'book__id')
+        lists[window, None] = list(top.values_list('book', field)[:TOP_SIZE])
+        for genre in genres:
+            lists[window, genre] = list(top.filter(book__genres=genre).values_list('book', field)[:TOP_SIZE])
+    return lists
+
+def stored_lists():
+    lists = {}
+    for window, genre, book, sales in Bestseller.objects.values_list('window', 'genre', 'book', 'sales'):
+        lists.setdefault((window, genre), []).append((book, sales))
+    return lists
+
+@transaction.commit_on_success
+def store(lists):
+    """Write the lists that changed; return them"""
+    old = stored_lists()
+    changed = {}
+    for key in set(old).union(lists):
+        if old.get(key, []) != lists.get(key, []):
+            changed[key] = lists.get(key, [])
+            window, genre = key
+            Bestseller.objects.filter(window=window, genre=genre).delete()
+            for position, (book, sales) in enumerate(changed[key]):
+                Bestseller.objects.create(window=window, genre_id=genre, position=position, book_id=book, sales=sales)
+    return changed
+
+def update_bestsellers():
+    """Slide the windows to today and store the lists that changed; return how many changed"""
+    today = date.today()
+    last = get_watermark('bestsellers.day')
+    if not last or (today - datetime.strptime(last, "%Y-%m-%d").date()).days > max(WINDOWS):
+        rebuild_sales(today)
+    else:
+        slide_windows(today)
+    changed = store(rank(today))
+    if changed:
+        for (window, genre), books in changed.items():
+            cache.set(BESTSELLER_CACHE_KEY % (window, genre), books, BESTSELLER_CACHE_TIMEOUT)
+        # pages' validators read this (see bookstore.conditional)
+        set_watermark('bestsellers', today.isoformat())
+        forget_tags('bestsellers', 'picks')
+    return len(changed)
+
+def top_books(window=30, genre=None, limit=TOP_SIZE):
+    """[(book id, sales)] for the best selling books in the window, overall or in a genre id"""
+    key = BESTSELLER_CACHE_KEY % (window, genre)
+    books = cache.get(key)
+    if books is None:
+        books = list(Bestseller.objects.filter(window=window, genre=genre).values_list('book', 'sales'))
+        cache.set(key, books, BESTSELLER_CACHE_TIMEOUT)
+    return books[:limit]
+
+def top_cards(window=30, genre=None, limit=TOP_SIZE):
+    """The best selling visible books in the window, loaded for {% bookcard %}, each with its sales"""
+    depend_on('bestsellers')
+    top = top_books(window, genre, limit)
+    found = Book.objects.filter(visible=True).in_bulk([id for id, sales in top])
+    books = []
+    for id, sales in top:
+        if id in found:
+            found[id].sales = sales
+            books.append(found[id])
+    return load_cards(books)
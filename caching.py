@@ -0,0 +1,89 @@
+# bookstore caching helpers
+from django.core.cache import cache
+
+import threading
+import time
+
+FRAGMENT_CACHE_KEY = 'bookstore.fragment.%s'
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# event counts for this process, by cache name; shown on the staff cache page
+stats = {}
+
+def count(name, event, n=1):
+    events = stats.setdefault(name, {})
+    events[event] = events.get(event, 0) + n
+
+def cached_fragment(name, render, tags=()):
+    """Return the cached html for fragment name, calling render() on a miss.
+
+    tags name the data the fragment shows, for the pages that include it.
+    """
+    depend_on(*tags)
+    key = FRAGMENT_CACHE_KEY % name
+    html = cache.get(key)
+    if html is None:
+        count(name, 'miss')
+        html = render()
+        cache.set(key, html, FRAGMENT_CACHE_TIMEOUT)
+    else:
+        count(name, 'hit')
+    return html
+
+def forget_fragments(*names):
+    cache.delete_many([FRAGMENT_CACHE_KEY % name for name in names])
+
+# Tags name the data a cached page shows: a model's name for all of its rows,
+# as in a listing, and "name:pk" for one row. Each tag's version is the time
+# it was last forgotten; a page cached with older versions is out of date.
+TAG_CACHE_KEY = 'bookstore.tag.%s'
+TAG_CACHE_TIMEOUT = 60 * 60 * 24 * 2    # longer than a page is kept
+
+_dependencies = threading.local()
+
+def model_tag(model, pk=None):
+    name = model._meta.object_name.lower()
+    if pk is None:
+        return name
+    return "%s:%s" % (name, pk)
+
+def begin_dependencies():
+    _dependencies.tags = set()
+
+def end_dependencies():
+    """The tags noted since begin_dependencies()"""
+    tags = getattr(_dependencies, 'tags', None) or set()
+    _dependencies.tags = None
+    return tags
+
+def depend_on(*tags):
+    """Note that the page being rendered shows the data named by tags"""
+    collected = getattr(_dependencies, 'tags', None)
+    if collected is not None:
+        collected.update(tags)
+
+def forget_tags(*tags):
+    """Put pages showing the data named by tags out of date"""
+    if tags:
+        now = time.time()
+        cache.set_many(dict((TAG_CACHE_KEY % tag, now) for tag in tags), TAG_CACHE_TIMEOUT)
+
+def tag_versions(tags, since):
+    """Current versions of tags, or None if any has changed since the time given.
+
+    A tag without a version, never forgotten or evicted, is given one of since.
+    """
+    keys = [TAG_CACHE_KEY % tag for tag in tags]
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, since, TAG_CACHE_TIMEOUT)
+        versions.update(cache.get_many(missing))
+    if len(versions) < len(keys) or [v for v in versions.values() if v > since]:
+        return None
+    return versions
+
+def tags_current(versions):
+    """True if no tag has changed since versions were read"""
+    return cache.get_many(versions.keys()) == versions
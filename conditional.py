@@ -0,0 +1,85 @@
+# bookstore conditional GET
+#
+# Validators for catalog pages, so repeat visitors and crawlers get 304s
+# without the page being rendered. A page's state is the newest modified date
+# among the rows it shows, and among the genres, authors and site pages every
+# page's sidebars show, read in one query. Saving a book's prices, reviews and
+# other parts updates the book's modified date, and deleting catalog rows is
+# noted in the 'catalog_deleted' watermark, so both count as changes, as do
+# changes to the author sidebar's order, noted in 'author_ranks'. Book pages
+# also read 'book_formats', noted when formats or resellers change.
+#
+#     @catalog_condition(lambda request, book_link, **kwargs: [Book.objects.filter(pk=routed_id('book', book_link))])
+#     def book_detail(request, book_link, ...):
+from django.db import connection
+from django.db.backends.util import typecast_timestamp
+from django.views.decorators.http import condition
+
+from bookstore.models import Genre, Person, SitePage, Watermark
+
+from datetime import date, datetime
+import hashlib
+import time
+
+def sidebar_parts():
+    """(queryset, date field) for what every page's sidebars show"""
+    return [
+        (Genre.objects.all(), 'modified'),
+        (Person.objects.all(), 'modified'),
+        (SitePage.objects.all(), 'modified'),
+        (Watermark.objects.filter(name__in=('catalog_deleted', 'author_ranks')), 'updated'),
+    ]
+
+def _as_datetime(value):
+    # a bare subquery's type isn't known to every backend, so sqlite gives a string
+    if isinstance(value, basestring):
+        return typecast_timestamp(value)
+    return value
+
+def newest(parts):
+    """Newest date among parts, as (queryset, date field) pairs, from a single query; None if they're empty"""
+    sql, params = [], []
+    for queryset, field in parts:
+        query = queryset.order_by('-' + field).values_list(field)[:1].query
+        q, p = query.get_compiler(connection=connection).as_sql()
+        sql.append("(%s)" % q)
+        params.extend(p)
+    cursor = connection.cursor()
+    cursor.execute("SELECT " + ", ".join(sql), params)
+    dates = [d for d in map(_as_datetime, cursor.fetchone()) if d]
+    return dates and max(dates) or None
+
+def page_modified(request, querysets):
+    """Newest modified date among the querysets' rows and the sidebars; memoized on the request.
+
+    A queryset may be given as a (queryset, date field) pair when its date field isn't modified.
+    """
+    if not hasattr(request, '_page_modified'):
+        parts = [isinstance(q, tuple) and q or (q, 'modified') for q in querysets] + sidebar_parts()
+        # pages list books by whether they're published yet, which changes at midnight
+        midnight = datetime.combine(date.today(), datetime.min.time())
+        request._page_modified = max(newest(parts), midnight)
+    return request._page_modified
+
+def page_etag(request, querysets):
+    """ETag for a page showing querysets to request's user"""
+    user = request.user.is_authenticated() and request.user.pk or 0
+    return hashlib.md5("%s|%s" % (page_modified(request, querysets), user)).hexdigest()
+
+def page_last_modified(request, querysets):
+    """Last-Modified for a page showing querysets, or None for a signed in user.
+
+    Signed in pages show the user, who can sign out without anything becoming
+    newer, so they are validated by ETag alone.
+    """
+    if request.user.is_authenticated():
+        return None
+    # condition() formats the date as UTC
+    local = page_modified(request, querysets)
+    return datetime.utcfromtimestamp(time.mktime(local.timetuple()))
+
+def catalog_condition(querysets):
+    """condition decorator for a view whose page shows querysets(request, *args, **kwargs)"""
+    return condition(
+        etag_func=lambda request, *args, **kwargs: page_etag(request, querysets(request, *args, **kwargs)),
+        last_modified_func=lambda request, *args, **kwargs: page_last_modified(request, querysets(request, *args, **kwargs)))
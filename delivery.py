@@ -0,0 +1,106 @@
+# bookstore ebook delivery
+#
+# BOOKSTORE_DELIVERY selects how files reach the customer:
+#   'stream'   - (default) django sends the file in chunks, honoring Range requests
+#   'sendfile' - the front-end server sends the file named by X-Sendfile (Apache mod_xsendfile, lighttpd)
+#   'accel'    - nginx sends the file at BOOKSTORE_DELIVERY_ACCEL_ROOT + the file's name, via X-Accel-Redirect;
+#                map that prefix to MEDIA_ROOT in an internal location
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.http import urlquote
+
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+_byte_range = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def parse_range(header, size):
+    """(start, stop) for a single Range header, None to send the whole file, or False if unsatisfiable"""
+    m = _byte_range.match((header or '').strip())
+    if not m:
+        return None
+    first, last = m.groups()
+    if first:
+        start = int(first)
+        stop = last and int(last) + 1 or size
+    elif last:
+        start = max(size - int(last), 0)
+        stop = size
+    else:
+        return None
+    stop = min(stop, size)
+    if start >= stop:
+        return False
+    return start, stop
+
+def served_from(request, response, size, etag=None):
+    """First byte of the file that response delivers.
+
+    A streamed response says so in its Content-Range; for sendfile and accel,
+    the front-end server honors Range and If-Range itself the same way.
+    """
+    if response.status_code == 206:
+        return int(response['Content-Range'].split(' ')[1].split('-')[0])
+    if response.status_code == 200 and (response.has_header('X-Sendfile') or response.has_header('X-Accel-Redirect')):
+        if_range = request.META.get('HTTP_IF_RANGE')
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        if byte_range and (not if_range or if_range == '"%s"' % etag):
+            return byte_range[0]
+    return 0
+
+def file_chunks(fieldfile, start, stop, chunk_size=CHUNK_SIZE):
+    f = fieldfile.storage.open(fieldfile.name, 'rb')
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def serve_file(request, fieldfile, content_type, filename, size=None, etag=None):
+    """Return a response that delivers fieldfile as an attachment named filename.
+
+    size and etag save a stat of the file when the caller already knows them;
+    etag is compared against If-Range before a partial response is sent.
+    """
+    mode = getattr(settings, 'BOOKSTORE_DELIVERY', 'stream')
+    if mode == 'sendfile':
+        response = HttpResponse('', content_type=content_type)
+        response['X-Sendfile'] = fieldfile.path
+    elif mode == 'accel':
+        response = HttpResponse('', content_type=content_type)
+        root = getattr(settings, 'BOOKSTORE_DELIVERY_ACCEL_ROOT', '/protected/')
+        response['X-Accel-Redirect'] = root + urlquote(fieldfile.name)
+    else:
+        response = stream_file(request, fieldfile, content_type, size, etag)
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+def stream_file(request, fieldfile, content_type, size=None, etag=None):
+    if size is None:
+        size = fieldfile.size
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if byte_range is not None and if_range and if_range != '"%s"' % etag:
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse('', content_type=content_type, status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+    if byte_range is None:
+        start, stop = 0, size
+        response = HttpResponse(file_chunks(fieldfile, start, stop), content_type=content_type)
+    else:
+        start, stop = byte_range
+        response = HttpResponse(file_chunks(fieldfile, start, stop), content_type=content_type, status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+    response['Content-Length'] = stop - start
+    response['Accept-Ranges'] = 'bytes'
+    return response
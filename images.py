@@ -0,0 +1,199 @@
+# bookstore image derivatives
+#
+# `manage.py build_images` renders smaller copies of uploaded images in a
+# process pool and records them in a manifest; the srcset filter reads the
+# manifest so pages can offer the smaller copies. Sources whose size and
+# modification time match the manifest are skipped.
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import simplejson
+
+from bookstore.models import Book, BookWallpaper
+from bookstore.caching import forget_tags, model_tag
+
+from multiprocessing import Pool
+import logging
+import os
+import time
+
+MANIFEST = getattr(settings, 'BOOKSTORE_IMAGE_MANIFEST',
+    os.path.join(settings.MEDIA_ROOT, 'bookstore', 'img', 'manifest.json'))
+JPEG_QUALITY = 85
+
+# (model, image field, derivatives as (name, bounding box), field to fill from a derivative)
+# Each derivative is saved beside its source as <source>.<name>.jpg. A fill
+# field left empty, such as a wallpaper with no thumbnail, or holding an older
+# derivative, is pointed at the named derivative.
+DERIVATIVES = (
+    (BookWallpaper, 'wallpaper', (('thumb', (220, 220)), ('thumb2x', (440, 440))), ('thumbnail', 'thumb')),
+    (Book, 'page_image', (('picks', (125, 187)), ('small', (150, 225)), ('small2x', (300, 450))), ('page_image_small', 'small')),
+)
+
+def derivative_name(source, name):
+    return "%s.%s.jpg" % (os.path.splitext(source)[0], name)
+
+def render(task):
+    """Write the derivatives for one source image; runs in a pool process.
+
+    Returns (source, manifest entry), or (source, None) if the image could not be read.
+    """
+    source, path, sizes = task
+    from PIL import Image
+    try:
+        stat = os.stat(path)
+        image = Image.open(path)
+        width, height = image.size
+        # decode a JPEG at the smallest scale that still covers the largest box
+        largest = max(box for name, box in sizes)
+        image.draft('RGB', largest)
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        image.load()
+    except (IOError, OSError), e:
+        logging.error("Image %s: %s" % (source, e))
+        return source, None
+
+    derivatives = []
+    for name, box in sorted(sizes, key=lambda size: size[1], reverse=True):
+        copy = image.copy()
+        copy.thumbnail(box, Image.ANTIALIAS)
+        filename = derivative_name(source, name)
+        target = derivative_name(path, name)
+        partial = target + '.part'
+        copy.save(partial, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+        os.rename(partial, target)
+        derivatives.append(dict(name=name, file=filename, width=copy.size[0], height=copy.size[1]))
+    return source, dict(mtime=stat.st_mtime, size=stat.st_size, width=width, height=height,
+        derivatives=derivatives)
+
+def is_current(entry, stat, sizes):
+    if not entry or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+        return False
+    if sorted(d['name'] for d in entry['derivatives']) != sorted(name for name, box in sizes):
+        return False
+    for d in entry['derivatives']:
+        if not os.path.exists(default_storage.path(d['file'])):
+            return False
+    return True
+
+def read_manifest():
+    try:
+        f = open(MANIFEST)
+    except IOError:
+        return {}
+    try:
+        return simplejson.load(f)
+    finally:
+        f.close()
+
+def write_manifest(entries):
+    partial = MANIFEST + '.part'
+    f = open(partial, 'w')
+    try:
+        simplejson.dump(entries, f, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(partial, MANIFEST)
+
+def derivative_files(*manifests):
+    return set(d['file'] for entries in manifests for entry in entries.values() for d in entry['derivatives'])
+
+def fill_fields(model, source_field, fill, entries, old=None):
+    """Point fill fields that are empty or hold a derivative at their source's derivative; return how many rows were updated"""
+    fill_field, derivative = fill
+    field = model._meta.get_field(fill_field)
+    # derivatives in this manifest or the last, or named like one from an earlier build
+    written = derivative_files(entries, old or {})
+    updated = []
+    book_field = model is Book and 'pk' or 'book'
+    for pk, book, source, current in model.objects.values_list('pk', book_field, source_field, fill_field):
+        entry = entries.get(source)
+        if not entry:
+            continue
+        d = [d for d in entry['derivatives'] if d['name'] == derivative][0]
+        if current and current != d['file'] and current not in written \
+                and not current.endswith('.%s.jpg' % derivative):
+            # provided by hand; a derivative is repointed, as after the source is replaced
+            continue
+        values = {fill_field: d['file']}
+        if field.width_field:
+            values[field.width_field] = d['width']
+        if field.height_field:
+            values[field.height_field] = d['height']
+        # update() so filling in doesn't touch modified dates or send signals
+        if model.objects.filter(pk=pk).exclude(**values).update(**values):
+            updated.append(book)
+    # cached pages show the filled fields
+    forget_tags(*[model_tag(Book, book) for book in updated])
+    return len(updated)
+
+def build(processes=None, force=False):
+    """Render missing and out of date derivatives; return (rendered, skipped, failed)"""
+    old = read_manifest()
+    entries = {}
+    tasks = []
+    for model, source_field, sizes, fill in DERIVATIVES:
+        for source in model.objects.exclude(**{source_field: ''}).values_list(source_field, flat=True).distinct():
+            path = default_storage.path(source)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                logging.error("Image %s: missing" % source)
+                continue
+            if not force and is_current(old.get(source), stat, sizes):
+                entries[source] = old[source]
+            else:
+                tasks.append((source, path, sizes))
+
+    rendered = failed = 0
+    if tasks:
+        pool = Pool(processes)
+        try:
+            for source, entry in pool.imap_unordered(render, tasks):
+                if entry is None:
+                    failed += 1
+                else:
+                    entries[source] = entry
+                    rendered += 1
+        finally:
+            pool.close()
+            pool.join()
+    if entries != old:
+        write_manifest(entries)
+    for model, source_field, sizes, fill in DERIVATIVES:
+        if fill:
+            fill_fields(model, source_field, fill, entries, old)
+    return rendered, len(entries) - rendered, failed
+
+_manifest = {}
+_manifest_checked = [0, None]
+MANIFEST_CHECK_INTERVAL = 10
+
+def manifest():
+    """The current manifest, reread when build_images rewrites it"""
+    global _manifest
+    now = time.time()
+    if now - _manifest_checked[0] > MANIFEST_CHECK_INTERVAL:
+        _manifest_checked[0] = now
+        try:
+            mtime = os.path.getmtime(MANIFEST)
+        except OSError:
+            mtime = None
+        if mtime != _manifest_checked[1]:
+            _manifest_checked[1] = mtime
+            _manifest = read_manifest()
+    return _manifest
+
+def manifest_version():
+    """mtime of the manifest in use, which changes when build_images rewrites it"""
+    manifest()
+    return _manifest_checked[1]
+
+def srcset(fieldfile):
+    """srcset attribute value offering fieldfile and its derivatives by width"""
+    entry = fieldfile and manifest().get(fieldfile.name)
+    if not entry:
+        return ''
+    candidates = [(d['width'], d['file']) for d in entry['derivatives']]
+    candidates.append((entry['width'], fieldfile.name))
+    return ', '.join("%s %dw" % (default_storage.url(name), width) for width, name in sorted(set(candidates)))
@@ -0,0 +1,29 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from bookstore.images import build
+
+import time
+
+class Command(NoArgsCommand):
+    help = "Render smaller copies of wallpapers and covers for thumbnails and srcset."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=None,
+            help='Images to render at once; defaults to the number of CPUs.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Render every image, even those already up to date.'),
+        make_option('--loop', type='int', dest='loop', default=0, metavar='SECONDS',
+            help='Keep running, checking for new images every SECONDS.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        force, loop = options['all'], options['loop']
+        while True:
+            rendered, skipped, failed = build(options['processes'], force)
+            if verbosity and (rendered or failed or not loop):
+                print "%d rendered, %d up to date, %d failed" % (rendered, skipped, failed)
+            if not loop:
+                break
+            force = False
+            time.sleep(loop)
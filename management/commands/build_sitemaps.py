@@ -0,0 +1,27 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from bookstore.sitemaps import update
+
+import time
+
+class Command(NoArgsCommand):
+    help = "Rewrite the sitemap files for pages that changed since they were last written."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Write every sitemap file.'),
+        make_option('--loop', type='int', dest='loop', default=0, metavar='SECONDS',
+            help='Keep running, checking for changes every SECONDS.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        rebuild, loop = options['rebuild'], options['loop']
+        while True:
+            written, removed = update(rebuild)
+            if verbosity and (written or removed or not loop):
+                print "%d sitemap files written, %d removed" % (written, removed)
+            if not loop:
+                break
+            rebuild = False
+            time.sleep(loop)
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from bookstore.routing import build_routes
+
+class Command(NoArgsCommand):
+    help = "Route the current links of books, authors, genres and site pages, and the old site's links."
+
+    def handle_noargs(self, **options):
+        written = build_routes()
+        if int(options.get('verbosity', 1)):
+            print "%d routes written" % written
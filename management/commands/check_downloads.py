@@ -0,0 +1,45 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from bookstore.models import Purchase, Download, summarize_downloads
+
+class Command(NoArgsCommand):
+    help = "Compare each purchase's download summary with the Download log."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--fix', action='store_true', dest='fix', default=False,
+            help='Rewrite summaries that differ from the log.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        fix = options.get('fix')
+
+        # stream the log once, grouped by purchase
+        logged = {}
+        current, timestamps = None, []
+        for purchase_id, timestamp in Download.objects.order_by('purchase', 'timestamp') \
+                .values_list('purchase', 'timestamp').iterator():
+            if purchase_id != current:
+                if current is not None:
+                    logged[current] = summarize_downloads(timestamps)
+                current, timestamps = purchase_id, []
+            timestamps.append(timestamp)
+        if current is not None:
+            logged[current] = summarize_downloads(timestamps)
+
+        empty = summarize_downloads([])
+        mismatched = 0
+        for purchase_id, count, first, recent in Purchase.objects.order_by() \
+                .values_list('id', 'download_count', 'first_download', 'recent_downloads').iterator():
+            expected = logged.get(purchase_id, empty)
+            if (count, first, recent) == expected:
+                continue
+            mismatched += 1
+            if verbosity > 1:
+                print "purchase %s: summary %r, log %r" % (purchase_id, (count, first, recent), expected)
+            if fix:
+                count, first, recent = expected
+                Purchase.objects.filter(pk=purchase_id).update(download_count=count,
+                    first_download=first, recent_downloads=recent)
+        if verbosity:
+            print "%d purchases differ from the download log%s" % (mismatched, fix and "; fixed" or "")
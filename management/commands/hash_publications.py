@@ -0,0 +1,29 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from bookstore.models import BookPublication
+
+class Command(NoArgsCommand):
+    help = "Store the content hash and size of BookPublication files that don't have them yet."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Rehash every publication, e.g. after replacing files outside the admin.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        pubs = BookPublication.objects.all()
+        if not options.get('all'):
+            pubs = pubs.filter(data_hash='')
+        hashed = 0
+        for pub in pubs.iterator():
+            try:
+                pub.hash_data()
+            except EnvironmentError, e:
+                print "%s: %s" % (pub.data.name, e)
+                continue
+            # update() instead of save() so the book's modified date is left alone
+            BookPublication.objects.filter(pk=pub.pk).update(data_hash=pub.data_hash, data_size=pub.data_size)
+            hashed += 1
+        if verbosity:
+            print "%d publications hashed" % hashed
@@ -0,0 +1,39 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from bookstore.paypal import VerifierPool, process_queued
+from bookstore.bestsellers import update_bestsellers
+
+import time
+
+class Command(NoArgsCommand):
+    help = "Verify queued PayPal IPN notifications and apply them to their purchases."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch', type='int', dest='batch', default=100,
+            help='Notifications to verify per batch.'),
+        make_option('--threads', type='int', dest='threads', default=4,
+            help='Concurrent verification requests, each on its own keep-alive connection.'),
+        make_option('--url', dest='url', default=None,
+            help='Verification url, overriding BOOKSTORE_PAYPAL_VERIFY_URL.'),
+        make_option('--loop', type='int', dest='loop', default=0, metavar='SECONDS',
+            help='Keep running, checking the queue every SECONDS once it is empty.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch, threads, loop = options['batch'], options['threads'], options['loop']
+        pool = VerifierPool(options['url'], size=threads)
+        try:
+            while True:
+                handled = process_queued(batch, pool, threads)
+                if handled:
+                    # completed purchases have been counted; rank them
+                    changed = update_bestsellers()
+                    if verbosity:
+                        print "%d notifications processed, %d bestseller lists changed" % (handled, changed)
+                if handled < batch:
+                    if not loop:
+                        break
+                    time.sleep(loop)
+        finally:
+            pool.close()
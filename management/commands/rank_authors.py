@@ -0,0 +1,28 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from bookstore.ranking import update_ranks, reset_ranks
+
+import time
+
+class Command(NoArgsCommand):
+    help = "Add purchases and downloads since the last run to author ranks."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Zero the ranks first and rank all past activity.'),
+        make_option('--loop', type='int', dest='loop', default=0, metavar='SECONDS',
+            help='Keep running, ranking new activity every SECONDS.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options['rebuild']:
+            reset_ranks()
+        loop = options['loop']
+        while True:
+            purchases, downloads = update_ranks()
+            if verbosity and (purchases or downloads or not loop):
+                print "%d purchases and %d downloads ranked" % (purchases, downloads)
+            if not loop:
+                break
+            time.sleep(loop)
@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+
+from bookstore.models import MARKUP_MODELS, render_markup
+
+class Command(NoArgsCommand):
+    help = "Re-render the stored html of every minifmt field, e.g. after changing the formatter."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in MARKUP_MODELS:
+            html_fields = [field + '_html' for field in model.markup_fields]
+            changed = 0
+            for instance in model.objects.only('pk', *(model.markup_fields + tuple(html_fields))).iterator():
+                if render_markup(instance):
+                    # update() instead of save() keeps modified and other signal handlers untouched
+                    model.objects.filter(pk=instance.pk).update(
+                        **dict((field, getattr(instance, field)) for field in html_fields))
+                    changed += 1
+            if verbosity:
+                print "%s: %d updated" % (model._meta.verbose_name_plural, changed)
@@ -0,0 +1,27 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from bookstore.outbox import send_queued
+
+import time
+
+class Command(NoArgsCommand):
+    help = "Send queued purchase emails."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch', type='int', dest='batch', default=50,
+            help='Emails to send per SMTP connection.'),
+        make_option('--loop', type='int', dest='loop', default=0, metavar='SECONDS',
+            help='Keep running, checking the queue every SECONDS once it is empty.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch, loop = options['batch'], options['loop']
+        while True:
+            sent, failed = send_queued(batch)
+            if verbosity and (sent or failed):
+                print "%d sent, %d failed" % (sent, failed)
+            if sent + failed < batch:
+                if not loop:
+                    break
+                time.sleep(loop)
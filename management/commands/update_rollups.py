@@ -0,0 +1,33 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from bookstore.reports import update_rollups, rebuild_rollups
+from bookstore.bestsellers import update_bestsellers
+
+import time
+
+class Command(NoArgsCommand):
+    help = "Add new sales and downloads to the daily rollups shown on the staff sales page, and slide the bestseller lists to today."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Discard the rollups and count all history again.'),
+        make_option('--loop', type='int', dest='loop', default=0, metavar='SECONDS',
+            help='Keep running, updating every SECONDS.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        loop = options['loop']
+        if options['rebuild']:
+            rebuild_rollups()
+        while True:
+            sales, downloads = update_rollups()
+            if verbosity and (sales or downloads or not loop):
+                print "%d sales, %d downloads added" % (sales, downloads)
+            # sales leave the windows as days pass, whether or not anything new was bought
+            changed = update_bestsellers()
+            if verbosity and (changed or not loop):
+                print "%d bestseller lists changed" % changed
+            if not loop:
+                break
+            time.sleep(loop)
@@ -0,0 +1,27 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+
+from bookstore.search import update_index
+
+import time
+
+class Command(NoArgsCommand):
+    help = "Reindex books modified since the search index was last saved."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Index every book into a new index.'),
+        make_option('--loop', type='int', dest='loop', default=0, metavar='SECONDS',
+            help='Keep running, checking for modified books every SECONDS.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        rebuild, loop = options['rebuild'], options['loop']
+        while True:
+            indexed, removed = update_index(rebuild)
+            if verbosity and (indexed or removed or not loop):
+                print "%d books indexed, %d removed" % (indexed, removed)
+            if not loop:
+                break
+            rebuild = False
+            time.sleep(loop)
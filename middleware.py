@@ -0,0 +1,21 @@
+from bookstore.models import begin_book_touches, end_book_touches
+
+class BookTouchMiddleware(object):
+    """Update each book's modified date once per request, however many of its parts were saved.
+
+    List it after TransactionMiddleware so the update is part of the request's transaction.
+    """
+    def process_request(self, request):
+        begin_book_touches()
+        request._book_touches = True
+
+    def process_exception(self, request, exception):
+        if getattr(request, '_book_touches', False):
+            request._book_touches = False
+            end_book_touches(discard=True)
+
+    def process_response(self, request, response):
+        if getattr(request, '_book_touches', False):
+            request._book_touches = False
+            end_book_touches()
+        return response
@@ -1,15 +1,18 @@
-from django.db import models
-from django.core.files import File
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
 from django.core.mail import EmailMessage
+from django.core.cache import cache
 from django.template.loader import render_to_string
+from bookstore.caching import forget_fragments, forget_tags, model_tag, count
+from bookstore.markup import minifmt
 from decimal import Decimal, ROUND_UP
 
 import cgi
+import time
 from datetime import datetime, date, timedelta
 from os import path
 import sha
-import logging
+import threading
 
 # HACK: make it possible to identify openiduser records in the admin interface.
 def user_unicode(self):
@@ -29,6 +32,11 @@ CURRENCY = (
 
 CURRENCY_SYMBOLS = dict(USD='$', GBP=u'\u00a3', EUR=u'\u20ac', CAD='(CA) $', AUD='(AU) $')
 
+PRICE_CACHE_KEY = 'bookstore.prices.%s'
+PRICE_CACHE_TIMEOUT = 60 * 60 * 24
+MERGED_CACHE_KEY = 'bookstore.merged.%s'
+MERGED_CACHE_TIMEOUT = 60 * 60 * 24
+
 # Base models
 class Genre(models.Model):
     link = models.SlugField("Genre Link", max_length=200, unique=True, help_text="Address: /genre/[LINK]")
@@ -37,6 +45,7 @@ class Genre(models.Model):
     visible = models.BooleanField("Visible", help_text="Show this genre in the store")
     display_order = models.IntegerField("Order", default=100, help_text="Show genres in this order")
     description = models.TextField("Description", help_text="Long description shown on genre's page")
+    description_html = models.TextField(editable=False, blank=True)
     text_color = models.SlugField("Text Color", help_text="Color of text on genre's image")
     page_color = models.SlugField("Page Color", help_text="Color of background on genre's image")
     page_image = models.ImageField(upload_to='bookstore/img/genre')
@@ -44,6 +53,8 @@ class Genre(models.Model):
     metadescription = models.TextField("Page Description", blank=True)
     modified = models.DateTimeField(auto_now=True)
 
+    markup_fields = ('description',)
+
     class Meta:
         ordering = ["display_order"]
 
@@ -58,6 +69,25 @@ class MergedUser(models.Model):
     name = models.CharField(max_length=200)
     accounts = models.ManyToManyField(User, related_name='+')
 
+def get_merged_account_ids(user_id):
+    """Ids of the accounts merged with user_id, including user_id itself.
+
+    Kept in the cache per user, and forgotten when a MergedUser's accounts change.
+    """
+    key = MERGED_CACHE_KEY % user_id
+    ids = cache.get(key)
+    if ids is None:
+        count('merged_accounts', 'miss')
+        through = MergedUser.accounts.through
+        groups = through.objects.filter(user=user_id).values('mergeduser')
+        ids = set(through.objects.filter(mergeduser__in=groups).values_list('user', flat=True))
+        ids.add(user_id)
+        ids = sorted(ids)
+        cache.set(key, ids, MERGED_CACHE_TIMEOUT)
+    else:
+        count('merged_accounts', 'hit')
+    return ids
+
 class Person(models.Model):
     link = models.SlugField("Author Link", max_length=200, unique=True, help_text="Address: /author/[LINK]")
     firstname = models.CharField("First Name", max_length=100)
@@ -66,12 +96,15 @@ class Person(models.Model):
     metakeywords = models.TextField("Page Keywords", blank=True, help_text="Useful only for Visible Authors")
     metadescription = models.TextField("Page Description", blank=True, help_text="Useful only for Visible Authors")
     biography = models.TextField("Biography", help_text="Useful only for Visible Authors")
+    biography_html = models.TextField(editable=False, blank=True)
 
     author = models.BooleanField("Is Author", help_text="Make this person available to be a Book Author")
     editor = models.BooleanField("Is Editor", help_text="Make this person available to be an Editor")
     visible = models.BooleanField("Visible", help_text="Show this author in the store")
     modified = models.DateTimeField(auto_now=True)
     rank = models.FloatField(default=0.0)
+
+    markup_fields = ('biography',)
     
     class Meta:
         ordering = ["lastname", "firstname"]
@@ -97,9 +130,11 @@ class Book(models.Model):
     ))
     title = models.CharField("Title", max_length=200)
     blurb = models.TextField("Blurb", help_text="Short description of the book shown in search results")
+    blurb_html = models.TextField(editable=False, blank=True)
     description = models.TextField("Description", help_text="Description shown on the book's page")
+    description_html = models.TextField(editable=False, blank=True)
     page_image = models.ImageField(upload_to='bookstore/img/book', help_text="Generally a 400x600 image of the book's cover")
-    page_image_small = models.ImageField(upload_to='bookstore/img/book', help_text="Generally a 150x225 version of the book's cover")
+    page_image_small = models.ImageField(upload_to='bookstore/img/book', blank=True, help_text="Generally a 150x225 version of the book's cover; made by build_images if not provided")
     added_date = models.DateField("Date added")
     publish_date = models.DateField("Date published", help_text="Consider as an upcoming book until this date; an available book thereafter.")
     ero_rating = models.CharField("Heat Rating", max_length=20, choices=(
@@ -120,6 +155,8 @@ class Book(models.Model):
     bestseller = models.BooleanField(default=False, help_text="Include this book as a potential bestseller")
     modified = models.DateTimeField(auto_now=True)
 
+    markup_fields = ('blurb', 'description')
+
     class Meta:
         ordering = ["-added_date"]
 
@@ -134,15 +171,51 @@ class Book(models.Model):
     def is_published(self):
         return self.publish_date <= date.today()
 
+    def author_list(self):
+        """authors in display order; preloaded by bookstore.catalog.load_cards"""
+        try: return self._authors
+        except AttributeError: return self.authors.all()
+
+    def genre_list(self):
+        """genres in display order; preloaded by bookstore.catalog.load_cards"""
+        try: return self._genres
+        except AttributeError: return self.genres.all()
+
     @property
-    def price(self, quantum=Decimal('.01')):
-        for price in self.price_set.filter(currency='USD'):
+    def prices(self):
+        """BookPrice per currency code, from the shared price cache"""
+        try: return self._prices
+        except AttributeError:
+            self._prices = get_book_prices([self.id])[self.id]
+            return self._prices
+
+    def read_prices(self):
+        """Load prices from the database instead of the price cache, which other processes may hold stale; for charging"""
+        self._prices = dict((price.currency, price) for price in self.price_set.all())
+
+    def get_price(self, currency='USD'):
+        """BookPrice for currency, or None"""
+        return self.prices.get(currency)
+
+    def display_price(self, currency='USD'):
+        price = self.get_price(currency)
+        if price:
             return "%s%s" % (price.symbol, price.quantized)
         return 'ERROR'
 
+    @property
+    def price(self, quantum=Decimal('.01')):
+        return self.display_price('USD')
+
     @property
     def is_free(self):
-        return self.price == "$0.00" or self.price.upper() == "FREE"
+        price = self.price
+        return price == "$0.00" or price.upper() == "FREE"
+
+    @property
+    def small_image(self):
+        """page_image_small, or the full cover until build_images makes the small one"""
+        return self.page_image_small or self.page_image
 
     def publications_by_format(self):
         return self.bookpublication_set.filter(format__visible=True).order_by('format__display_order').all()
@@ -168,12 +241,39 @@ class BookPrice(models.Model):
     def __unicode__(self):
         return "%s%s" % (self.symbol, self.price)
 
+def get_book_prices(book_ids):
+    """Map each book id to its BookPrice per currency code.
+
+    Prices are kept in the cache per book, so this costs no queries once warm
+    and a single query for all misses otherwise. The BookPrice instances are
+    rebuilt from cached values; treat them as read-only. Only the process
+    that saves a BookPrice forgets its entry, so these are for display; what a
+    purchase charges comes from Book.read_prices.
+    """
+    keys = dict((PRICE_CACHE_KEY % id, id) for id in book_ids)
+    cached = cache.get_many(keys.keys())
+    rows = dict((keys[key], value) for key, value in cached.items())
+    missing = [id for id in keys.values() if id not in rows]
+    if missing:
+        for id in missing:
+            rows[id] = []
+        for id, book_id, currency, price in BookPrice.objects.filter(book__in=missing) \
+                .values_list('id', 'book', 'currency', 'price'):
+            rows[book_id].append((id, currency, price))
+        cache.set_many(dict((PRICE_CACHE_KEY % id, rows[id]) for id in missing), PRICE_CACHE_TIMEOUT)
+    return dict((book_id, dict((currency, BookPrice(id=id, book_id=book_id, currency=currency, price=price))
+        for id, currency, price in row)) for book_id, row in rows.items())
+
 class BookReview(models.Model):
     book = models.ForeignKey(Book)
     quote = models.TextField()
+    quote_html = models.TextField(editable=False, blank=True)
     reviewer = models.TextField()
+    reviewer_html = models.TextField(editable=False, blank=True)
     date = models.DateField()
 
+    markup_fields = ('quote', 'reviewer')
+
     class Meta:
         ordering = ["-date"]
 
@@ -183,12 +283,15 @@ class BookReview(models.Model):
 class BookMedia(models.Model):
     book = models.ForeignKey(Book)
     writeup = models.TextField()
+    writeup_html = models.TextField(editable=False, blank=True)
     video_size = models.CharField("Video Size", max_length=20, choices=(
         ('500x405', "500 by 405"),
         ('480x385', "480 by 385"),
     ))
     youtube = models.CharField("Youtube Video Key", max_length=50, blank=True)
 
+    markup_fields = ('writeup',)
+
     def __unicode__(self):
         return "%s %s (%s)" % (self.book.title, self.video_size, self.youtube)
         
@@ -208,7 +311,7 @@ class BookMedia(models.Model):
 class BookWallpaper(models.Model):
     book = models.ForeignKey(Book)
     wallpaper = models.ImageField(upload_to='bookstore/img/wall', width_field="wallwidth", height_field="wallheight", help_text="Try to include the largest of any of these size groups. There's no need to include more than one.\n16x10: 1920x1200, 1440x900, 1280x800\n4x3: 1600x1200, 1024x768\n16x9: 1920x1080\n5x4: 1280x1024")
-    thumbnail = models.ImageField(upload_to='bookstore/img/wall', width_field="thumbwidth", height_field="thumbheight", help_text="Automatically generated if not provided")
+    thumbnail = models.ImageField(upload_to='bookstore/img/wall', width_field="thumbwidth", height_field="thumbheight", blank=True, help_text="Made by build_images if not provided")
     wallwidth = models.IntegerField()
     wallheight = models.IntegerField()
     thumbwidth = models.IntegerField(default=0)
@@ -238,6 +341,8 @@ class BookPublication(models.Model):
     book = models.ForeignKey(Book)
     format = models.ForeignKey(BookFormat)
     data = models.FileField(upload_to='bookstore/ebook/%Y')
+    data_hash = models.CharField(max_length=40, editable=False, blank=True, help_text="SHA-1 of data")
+    data_size = models.IntegerField(editable=False, default=0, help_text="Size of data in bytes")
 
     @models.permalink
     def get_purchase_url(self):
@@ -254,8 +359,22 @@ class BookPublication(models.Model):
         return "%s in %s" % (self.book.title, self.format.name)
         
     def get_etag(self):
+        if self.data_hash:
+            return self.data_hash
         return sha.new(str(self.book.title) + str(path.getmtime(self.data.path))).hexdigest()
 
+    def hash_data(self):
+        """Read data and set data_hash and data_size from it"""
+        digest = sha.new()
+        size = 0
+        for chunk in self.data.chunks():
+            digest.update(chunk)
+            size += len(chunk)
+        if self.data._committed:
+            self.data.close()
+        self.data_hash = digest.hexdigest()
+        self.data_size = size
+
 class BookReseller(models.Model):
     name = models.CharField(max_length=200, unique=True)
     display_order = models.IntegerField()
@@ -289,6 +408,9 @@ class SiteNewsBanner(models.Model):
     height = models.IntegerField()
     title = models.CharField(max_length=500, help_text="Hover text for the image")
     text = models.TextField(help_text="Text accompanying the image")
+    text_html = models.TextField(editable=False, blank=True)
+
+    markup_fields = ('text',)
     
     class Meta:
         ordering = ["display_order"]
@@ -299,6 +421,7 @@ class SitePage(models.Model):
     metakeywords = models.TextField("Page Keywords", blank=True, help_text="Leave empty to use defaults")
     metadescription = models.TextField("Page Description", blank=True, help_text="Leave empty to use defaults")
     content = models.TextField()
+    content_html = models.TextField(editable=False, blank=True)
     visible = models.BooleanField(default=True, help_text="Allow page to be loaded")
     showinheader = models.BooleanField("List in Header", default=True, help_text="Show page in tabs at top")
     showinfooter = models.BooleanField("List in Footer", default=True, help_text="Show page in list at bottom")
@@ -306,6 +429,8 @@ class SitePage(models.Model):
     display_order = models.IntegerField("Order", default=100, help_text="Show page links in this order")
     modified = models.DateTimeField(auto_now=True)
 
+    markup_fields = ('content',)
+
     class Meta:
         ordering = ["display_order"]
 
@@ -356,6 +481,18 @@ class StorefrontAd(models.Model):
     def __unicode__(self):
         return "%s [%s] (%s)" % (self.description, self.column, self.link)
 
+# recent download times kept per purchase; enough for the limits in is_available_to
+DOWNLOAD_RING_SIZE = 8
+RESUME_WINDOW = timedelta(hours=6)    # how long after a download its transfer may be resumed once uncounted
+
+def _epoch(timestamp):
+    return str(int(time.mktime(timestamp.timetuple())))
+
+def summarize_downloads(timestamps):
+    """download_count, first_download and recent_downloads for timestamps in ascending order"""
+    return (len(timestamps), timestamps and timestamps[0] or None,
+        ','.join(_epoch(t) for t in timestamps[-DOWNLOAD_RING_SIZE:]))
+
 class Purchase(models.Model):
     transaction = models.CharField(max_length=10, default='P', choices=(
         ('P', 'Purchase'),
@@ -376,13 +513,19 @@ class Purchase(models.Model):
     admin = models.ForeignKey(User, null=True, related_name="purchase_admin_set")
     customer = models.ForeignKey(User, related_name="purchase_customer_set")
     email = models.EmailField()
-    date = models.DateTimeField(auto_now_add=True)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
     address = models.CharField(max_length=256)
     email_name = models.CharField(max_length=200, blank=True)
     email_address = models.EmailField(blank=True)
     email_link = models.CharField(max_length=256, blank=True)
     email_sent = models.BooleanField(default=False)
     email_sent_date = models.DateTimeField(null=True)
+    download_count = models.IntegerField(default=0, editable=False)
+    first_download = models.DateTimeField(null=True, editable=False)
+    recent_downloads = models.CharField(max_length=200, blank=True, editable=False,
+        help_text="Times of the latest downloads, as comma separated seconds since the epoch")
+    ready_date = models.DateTimeField(null=True, editable=False, db_index=True,
+        help_text="When the purchase first became ready; sales reports count it on this date")
     
     @property
     def book(self):
@@ -404,29 +547,80 @@ class Purchase(models.Model):
         if self.transaction in 'PFR':
             # since there's a ready purchase, check for abusive download patterns
             now = datetime.now()
-            downloads = self.download_set
-            lastweek = downloads.filter(timestamp__gte=now - timedelta(days=7))
-            lastmonth = downloads.filter(timestamp__gte=now - timedelta(days=30))
-            if lastweek.count() >= 5 or lastmonth.count() >= 8:
+            recent = self.recent_download_times()
+            lastweek = [t for t in recent if t >= now - timedelta(days=7)]
+            lastmonth = [t for t in recent if t >= now - timedelta(days=30)]
+            if len(lastweek) >= 5 or len(lastmonth) >= 8:
                 return False
             return True
         if self.transaction in 'V':
             # there's a ready review; check for date or count violations
-            downloads = self.download_set
             now = datetime.now()
-            downloaded = downloads.count()
+            downloaded = self.download_count
             if self.date + timedelta(days=3) < now \
-                or downloaded >= 3 or (downloaded >= 1 and
-                downloads.order_by('timestamp')[0].timestamp + timedelta(days=1) < now):
+                or downloaded >= 3 or (downloaded >= 1 and self.first_download and
+                self.first_download + timedelta(days=1) < now):
+                # update(), so this copy's download summary, which may be stale, isn't written back
                 self.status = 'X'
-                self.save()
+                Purchase.objects.filter(pk=self.pk).update(status='X')
                 return False
             return True
         return False
 
+    def recent_download_times(self):
+        return [datetime.fromtimestamp(int(t)) for t in self.recent_downloads.split(',') if t]
+
+    def resume_download(self, etag, offset):
+        """True if a transfer of the file with etag from byte offset resumes the latest download.
+
+        A download recorded within RESUME_WINDOW may be resumed from past the
+        byte it was last sent from, and its offset then moves to the resume's,
+        so each resume continues one transfer and a repeated one is counted.
+        """
+        latest = list(Download.objects.filter(purchase=self, etag=etag or '',
+            timestamp__gte=datetime.now() - RESUME_WINDOW).order_by('-pk').values_list('pk', flat=True)[:1])
+        # one update, so racing requests can't both resume from the same offset
+        return bool(latest and Download.objects.filter(pk=latest[0], offset__lt=offset).update(offset=offset))
+
+    def record_download(self, ipaddress, etag='', offset=0):
+        """Log a download of the file with etag, sent from byte offset, and update this purchase's download summary"""
+        if transaction.is_managed():
+            # the enclosing transaction holds the row lock until it ends
+            return self._record_download(ipaddress, etag, offset)
+        return transaction.commit_on_success(self._record_download)(ipaddress, etag, offset)
+
+    def _record_download(self, ipaddress, etag, offset):
+        download = Download.objects.create(purchase=self, ipaddress=ipaddress, etag=etag or '', offset=offset)
+        purchases = Purchase.objects.filter(pk=self.pk)
+        # the update locks the row until commit, so the summary read next includes any racing download
+        purchases.update(download_count=models.F('download_count') + 1)
+        self.download_count, first, recent = purchases.values_list('download_count', 'first_download', 'recent_downloads')[0]
+        recent = recent.split(',')[-(DOWNLOAD_RING_SIZE - 1):] + [_epoch(download.timestamp)]
+        self.recent_downloads = ','.join(t for t in recent if t)
+        self.first_download = first or download.timestamp
+        # update() leaves the post_save handlers alone
+        purchases.update(first_download=self.first_download, recent_downloads=self.recent_downloads)
+        return download
+
     def get_key(self):
         return sha.new(self.email_address + str(self.id)).hexdigest()
 
+    def email_message(self):
+        """the EmailMessage telling the customer their purchase is ready"""
+        message = EmailMessage()
+        message.to = [self.email_address]
+        if self.email_name:
+            message.to = ['"%s" <%s>' % (self.email_name, self.email_address)]
+        template = "bookstore/email_purchased.txt"
+        message.subject = "Your Lillibridge Press eBook Purchase"
+        message.from_email = "Lillibridge Press Sales <sales@lillibridgepress.com>"
+        if self.transaction == "V":
+            template = "bookstore/email_review.txt"
+            message.subject = "Your Lillibridge Press eBook Review Copy"
+        message.body = render_to_string(template,
+            dict(purchase=self, book=self.publication.book))
+        return message
+
     @models.permalink
     def get_absolute_url(self):
         return ('bookstore.views.purchase_detail', (), dict(purchase_id=self.id))
@@ -445,6 +639,16 @@ class PaypalIpn(models.Model):
     currency = models.CharField(max_length=5, default='USD', choices=CURRENCY)
     payment_status = models.CharField(max_length=50)
     entered = models.DateTimeField(auto_now_add=True)
+    txn_id = models.CharField("PayPal Transaction", max_length=50, blank=True, db_index=True)
+    state = models.CharField(max_length=5, default='A', db_index=True, choices=(
+        ('Q', 'Queued'),
+        ('A', 'Applied'),
+        ('D', 'Duplicate'),
+        ('I', 'Invalid'),
+        ('B', 'Bad Payment'),
+    ))
+    download_link = models.CharField(max_length=256, blank=True, help_text="Download url to email once paid")
+    processed = models.DateTimeField(null=True)
     
     def parse_params(self):
         return cgi.parse_qsl(self.params)
@@ -453,11 +657,100 @@ class Download(models.Model):
     purchase = models.ForeignKey(Purchase)
     timestamp = models.DateTimeField(auto_now_add=True)
     ipaddress = models.IPAddressField()
+    etag = models.CharField(max_length=40, blank=True, help_text="Hash of the file sent, for telling resumed transfers apart")
+    offset = models.IntegerField(default=0, help_text="Byte the file was last sent from; a resumed transfer moves it on")
+
+class PurchaseEmail(models.Model):
+    purchase = models.ForeignKey(Purchase, unique=True)
+    queued = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=datetime.now, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    sent = models.DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        ordering = ["next_attempt"]
+
+    def __unicode__(self):
+        return "Email for %s" % self.purchase
+
+class Watermark(models.Model):
+    """How far a batch job has read through its source table"""
+    name = models.CharField(max_length=50, unique=True)
+    value = models.CharField(max_length=50, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "%s at %s" % (self.name, self.value)
+
+class SalesRollup(models.Model):
+    """Ready purchases per day, maintained by update_rollups"""
+    day = models.DateField(db_index=True)
+    book = models.ForeignKey(Book)
+    format = models.ForeignKey(BookFormat)
+    currency = models.CharField(max_length=5, choices=CURRENCY)
+    transaction = models.CharField(max_length=10, choices=Purchase._meta.get_field('transaction').choices)
+    sales = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=3, default=0)
+
+    class Meta:
+        unique_together = ("day", "book", "format", "currency", "transaction")
+
+class DownloadRollup(models.Model):
+    """Downloads per day, maintained by update_rollups"""
+    day = models.DateField(db_index=True)
+    book = models.ForeignKey(Book)
+    format = models.ForeignKey(BookFormat)
+    downloads = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ("day", "book", "format")
+
+class BookSales(models.Model):
+    """Ready purchases of a book in the last 7, 30 and 90 days, including today; see bookstore.bestsellers"""
+    book = models.ForeignKey(Book, unique=True)
+    sales_7 = models.IntegerField(default=0)
+    sales_30 = models.IntegerField(default=0)
+    sales_90 = models.IntegerField(default=0)
+
+class Bestseller(models.Model):
+    """A place in a bestseller list, for the sales window given and overall or for a genre"""
+    window = models.IntegerField()
+    genre = models.ForeignKey(Genre, null=True, blank=True)
+    position = models.IntegerField()
+    book = models.ForeignKey(Book)
+    sales = models.IntegerField()
+
+    class Meta:
+        ordering = ("window", "genre", "position")
+
+ROUTE_KINDS = (
+    ('book', 'Book'),
+    ('author', 'Author'),
+    ('genre', 'Genre'),
+    ('page', 'Site page'),
+)
+
+class SlugRoute(models.Model):
+    """A current or former link to a book, author, genre or site page; see bookstore.routing"""
+    kind = models.CharField(max_length=10, choices=ROUTE_KINDS)
+    slug = models.CharField(max_length=200, help_text="The link in lower case")
+    object_id = models.IntegerField()
+    link = models.CharField(max_length=200, help_text="The object's current link")
+
+    class Meta:
+        unique_together = ("kind", "slug")
+
+    def __unicode__(self):
+        return "%s %s -> %s" % (self.kind, self.slug, self.link)
+
+ROUTE_MODELS = {Book: 'book', Person: 'author', Genre: 'genre', SitePage: 'page'}
 
 #
 # Signal handling
 #
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import Signal
 #from django.dispatch import receiver
 def receiver(signal, **kwargs):
     def connector(handler):
@@ -465,39 +758,60 @@ def receiver(signal, **kwargs):
         return handler
     return connector
         
-@receiver(post_save, sender=Purchase, dispatch_uid="send_purchase_email@Purchase")
-def send_purchase_email(sender, **kwargs):
+# models with minifmt source fields, each rendered into a matching *_html field
+MARKUP_MODELS = (Genre, Person, Book, BookReview, BookMedia, SiteNewsBanner, SitePage)
+
+def render_markup(instance):
+    """Render instance's markup_fields; return True if any *_html field changed"""
+    changed = False
+    for field in instance.markup_fields:
+        html = minifmt(getattr(instance, field))
+        if getattr(instance, field + '_html') != html:
+            setattr(instance, field + '_html', html)
+            changed = True
+    return changed
+
+def render_markup_on_save(sender, **kwargs):
+    render_markup(kwargs['instance'])
+
+for model in MARKUP_MODELS:
+    pre_save.connect(render_markup_on_save, sender=model, dispatch_uid="render_markup@%s" % model.__name__)
+
+@receiver(pre_save, sender=Purchase, dispatch_uid="date_purchase_ready@Purchase")
+def date_purchase_ready(sender, **kwargs):
+    purchase = kwargs['instance']
+    if purchase.status == 'R' and not purchase.ready_date:
+        purchase.ready_date = datetime.now()
+        purchase._became_ready = True
+
+@receiver(post_save, sender=Purchase, dispatch_uid="count_book_sale@Purchase")
+def count_book_sale(sender, **kwargs):
+    # counted once, in the purchase's transaction; bookstore.bestsellers slides the windows
+    purchase = kwargs['instance']
+    if getattr(purchase, '_became_ready', False):
+        purchase._became_ready = False
+        if purchase.transaction == 'V':
+            # review copies aren't sales
+            return
+        book = BookPublication.objects.filter(pk=purchase.publication_id).values_list('book', flat=True)[0]
+        added = dict((field, models.F(field) + 1) for field in ('sales_7', 'sales_30', 'sales_90'))
+        if BookSales.objects.filter(book=book).update(**added):
+            return
+        # a racing first sale may create the row first; the savepoint keeps the purchase's transaction usable
+        sid = transaction.savepoint()
+        try:
+            BookSales.objects.create(book_id=book, sales_7=1, sales_30=1, sales_90=1)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            BookSales.objects.filter(book=book).update(**added)
+
+@receiver(post_save, sender=Purchase, dispatch_uid="queue_purchase_email@Purchase")
+def queue_purchase_email(sender, **kwargs):
+    # queued in the same transaction as the purchase; bookstore.outbox sends it
     purchase = kwargs.get('instance')
-    created = kwargs.get('created')
     if purchase and purchase.status == 'R' and not purchase.email_sent and purchase.email_address:
-        message = EmailMessage()
-        message.to = purchase.email_address
-        if purchase.email_name:
-            message.to = ['"%s" <%s>' % (purchase.email_name, purchase.email_address)]
-        template = "bookstore/email_purchased.txt"
-        message.subject = "Your Lillibridge Press eBook Purchase"
-        message.from_email = "Lillibridge Press Sales <sales@lillibridgepress.com>"
-        if purchase.transaction == "V":
-            template = "bookstore/email_review.txt"
-            message.subject = "Your Lillibridge Press eBook Review Copy"
-        message.body = render_to_string(template, 
-            dict(purchase=purchase, book=purchase.publication.book))
-        
-        try:
-            message.send()
-            purchase.email_sent_date = datetime.now()
-            purchase.email_sent = True
-            purchase.save()
-        except Exception as e:
-            logging.exception("Purchase Email")
-
-        #subject, from_email, to = 'hello', 'from@example.com', 'to@example.com'
-        #text_content = 'This is an important message.'
-        #html_content = '<p>This is an <strong>important</strong> message.</p>'
-        #msg = EmailMultiAlternatives(subject, text_content, from_email, [to])
-        #msg.attach_alternative(html_content, "text/html")
-        #msg.headers["Precendence"] = "bulk"
-        #msg.headers["List-Unsubscribe"] = ...
+        PurchaseEmail.objects.get_or_create(purchase=purchase)
 
 @receiver(post_save, sender=BookPrice, dispatch_uid="update_book_modified@BookPrice")
 @receiver(post_save, sender=BookReview, dispatch_uid="update_book_modified@BookReview")
@@ -505,36 +819,213 @@ def send_purchase_email(sender, **kwargs):
 @receiver(post_save, sender=BookPublication, dispatch_uid="update_book_modified@BookPublication")
 @receiver(post_save, sender=BookListing, dispatch_uid="update_book_modified@BookListing")
 @receiver(post_save, sender=BookMedia, dispatch_uid="update_book_modified@BookMedia")
+@receiver(post_delete, sender=BookPrice, dispatch_uid="update_book_modified@BookPrice")
+@receiver(post_delete, sender=BookReview, dispatch_uid="update_book_modified@BookReview")
+@receiver(post_delete, sender=BookWallpaper, dispatch_uid="update_book_modified@BookWallpaper")
+@receiver(post_delete, sender=BookPublication, dispatch_uid="update_book_modified@BookPublication")
+@receiver(post_delete, sender=BookListing, dispatch_uid="update_book_modified@BookListing")
+@receiver(post_delete, sender=BookMedia, dispatch_uid="update_book_modified@BookMedia")
 def update_book_modified(sender, **kwargs):
     instance = kwargs.get('instance')
     if instance:
-        instance.book.save()
-
-@receiver(post_save, sender=BookWallpaper, dispatch_uid="wallpaper_thumbnail@BookWallpaper")
-def wallpaper_thumbnail(sender, **kwargs):
-    w = kwargs["instance"]
-    from os import path
-    try:
-        wallpath = w.wallpaper.path
-        thumbpath = w.thumbnail.path
-    except ValueError:
-        thumbpath = path.splitext(wallpath)[0] + ".thumb.jpg"
-    try:
-        if path.getmtime(wallpath) <= path.getmtime(thumbpath):
+        touch_book(instance.book_id)
+
+# Sent after Book.modified is updated for book_ids, without a Book save.
+books_touched = Signal(providing_args=["book_ids"])
+
+# Books whose modified date is due, collected per thread while a batch is
+# open; BookTouchMiddleware opens one around each request, so saving a book
+# with its inlines in the admin updates the book once.
+_touches = threading.local()
+
+def begin_book_touches():
+    _touches.depth = getattr(_touches, 'depth', 0) + 1
+    if _touches.depth == 1:
+        _touches.book_ids = set()
+
+def end_book_touches(discard=False):
+    """Close a batch, updating the books touched in it once the outermost batch closes"""
+    _touches.depth -= 1
+    if _touches.depth == 0:
+        book_ids, _touches.book_ids = _touches.book_ids, None
+        if book_ids and not discard:
+            update_books_modified(book_ids)
+
+def touch_book(book_id):
+    touch_books([book_id])
+
+def touch_books(book_ids):
+    book_ids = list(book_ids)
+    if not book_ids:
+        return
+    count('book_modified', 'touched', len(book_ids))
+    if getattr(_touches, 'depth', 0):
+        for book_id in book_ids:
+            if book_id in _touches.book_ids:
+                count('book_modified', 'avoided')
+            _touches.book_ids.add(book_id)
+    else:
+        update_books_modified(book_ids)
+
+def update_books_modified(book_ids):
+    book_ids = list(book_ids)
+    Book.objects.filter(pk__in=book_ids).update(modified=datetime.now())
+    count('book_modified', 'written', len(book_ids))
+    books_touched.send(sender=Book, book_ids=book_ids)
+
+@receiver(m2m_changed, sender=Book.authors.through, dispatch_uid="touch_related_books@Book.authors")
+@receiver(m2m_changed, sender=Book.genres.through, dispatch_uid="touch_related_books@Book.genres")
+def touch_related_books(sender, **kwargs):
+    # changing a book's authors or genres changes the book, from either side,
+    # and the author or genre, whose page lists the book
+    instance, action, model = kwargs['instance'], kwargs['action'], kwargs['model']
+    if isinstance(instance, Book):
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            touch_book(instance.pk)
+        if action in ('post_add', 'post_remove'):
+            related = kwargs['pk_set'] or ()
+        elif action == 'pre_clear':
+            related = list(model.objects.filter(book=instance).values_list('pk', flat=True))
+        else:
             return
-    except EnvironmentError:
-        pass
-    
-    from PIL import Image
-    image = Image.open(w.wallpaper.path)
-    if image.mode not in ('L', 'RGB'):
-        image = image.convert('RGB')
-    image.thumbnail((220, 220), Image.ANTIALIAS)
-
-    from StringIO import StringIO
-    data = StringIO()
-    image.save(data, "JPEG")
-    data.size = data.tell()
-    data.seek(0, 0)
-    #data.name = path.basename(thumbpath)
-    w.thumbnail.save(path.basename(thumbpath), File(data))
+        model.objects.filter(pk__in=related).update(modified=datetime.now())
+        forget_tags(*[model_tag(model, pk) for pk in related])
+        return
+    if action in ('post_add', 'post_remove'):
+        touch_books(kwargs['pk_set'] or ())
+    elif action == 'pre_clear':
+        touch_books(instance.book_set.values_list('pk', flat=True))
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        forget_tags(model_tag(type(instance), instance.pk))
+
+@receiver(post_save, sender=Person, dispatch_uid="touch_named_books@Person")
+@receiver(post_save, sender=Genre, dispatch_uid="touch_named_books@Genre")
+def touch_named_books(sender, **kwargs):
+    # books show their authors' and genres' names
+    if not kwargs.get('created'):
+        touch_books(kwargs['instance'].book_set.values_list('pk', flat=True))
+
+def route_link(kind, link, object_id, current):
+    """Point the route for link at object_id, whose current link is current"""
+    if not SlugRoute.objects.filter(kind=kind, slug=link.lower()).update(object_id=object_id, link=current):
+        SlugRoute.objects.create(kind=kind, slug=link.lower(), object_id=object_id, link=current)
+
+# fields whose saved values post_save receivers compare with the new ones
+WATCHED_FIELDS = {
+    Book: ('link', 'visible', 'bestseller', 'feature'),
+    Person: ('link',),
+    Genre: ('link',),
+    SitePage: ('link',),
+}
+
+def note_old_values(sender, **kwargs):
+    instance = kwargs['instance']
+    old = instance.pk and list(sender.objects.filter(pk=instance.pk).values(*WATCHED_FIELDS[sender]))
+    instance._old_values = old and old[0] or {}
+
+def route_links(sender, **kwargs):
+    # a changed link leaves its old route behind, pointing at the new one
+    instance, kind = kwargs['instance'], ROUTE_MODELS[sender]
+    old = getattr(instance, '_old_values', {}).get('link')
+    if old == instance.link and not kwargs.get('created'):
+        return
+    SlugRoute.objects.filter(kind=kind, object_id=instance.pk).update(link=instance.link)
+    if old and old.lower() != instance.link.lower():
+        route_link(kind, old, instance.pk, instance.link)
+    route_link(kind, instance.link, instance.pk, instance.link)
+    from bookstore.routing import forget_routes
+    forget_routes()
+
+def forget_links(sender, **kwargs):
+    SlugRoute.objects.filter(kind=ROUTE_MODELS[sender], object_id=kwargs['instance'].pk).delete()
+    from bookstore.routing import forget_routes
+    forget_routes()
+
+for model in ROUTE_MODELS:
+    pre_save.connect(note_old_values, sender=model, dispatch_uid="note_old_values@%s" % model.__name__)
+    post_save.connect(route_links, sender=model, dispatch_uid="route_links@%s" % model.__name__)
+    post_delete.connect(forget_links, sender=model, dispatch_uid="forget_links@%s" % model.__name__)
+
+@receiver(post_save, sender=Book, dispatch_uid="forget_pick_pools@Book")
+@receiver(post_delete, sender=Book, dispatch_uid="forget_pick_pools@Book")
+def forget_pick_pools(sender, **kwargs):
+    # bookstore.picks draws from visible bestsellers and featured books
+    instance = kwargs['instance']
+    old = getattr(instance, '_old_values', {})
+    if 'created' not in kwargs or [f for f in ('visible', 'bestseller', 'feature') if old.get(f) != getattr(instance, f)]:
+        forget_tags('picks')
+
+# catalog rows shown on pages cached by bookstore.pagecache
+PAGE_MODELS = (Book, Genre, Person, SitePage, StorefrontNewsCard, StorefrontAd, BookFormat, BookReseller)
+
+def forget_pages(sender, **kwargs):
+    forget_tags(model_tag(sender), model_tag(sender, kwargs['instance'].pk))
+
+for model in PAGE_MODELS:
+    post_save.connect(forget_pages, sender=model, dispatch_uid="forget_pages@%s" % model.__name__)
+    post_delete.connect(forget_pages, sender=model, dispatch_uid="forget_pages@%s" % model.__name__)
+
+@receiver(books_touched, dispatch_uid="forget_book_pages")
+def forget_book_pages(sender, **kwargs):
+    # prices, reviews and other parts of the books changed
+    forget_tags(*[model_tag(Book, id) for id in kwargs['book_ids']])
+
+@receiver(post_delete, sender=Book, dispatch_uid="note_catalog_deletion@Book")
+@receiver(post_delete, sender=Genre, dispatch_uid="note_catalog_deletion@Genre")
+@receiver(post_delete, sender=Person, dispatch_uid="note_catalog_deletion@Person")
+@receiver(post_delete, sender=SitePage, dispatch_uid="note_catalog_deletion@SitePage")
+@receiver(post_delete, sender=StorefrontNewsCard, dispatch_uid="note_catalog_deletion@StorefrontNewsCard")
+@receiver(post_delete, sender=StorefrontAd, dispatch_uid="note_catalog_deletion@StorefrontAd")
+def note_catalog_deletion(sender, **kwargs):
+    # a deleted row leaves no modified date behind; bookstore.conditional reads this instead
+    if not Watermark.objects.filter(name='catalog_deleted').update(updated=datetime.now()):
+        Watermark.objects.create(name='catalog_deleted')
+
+@receiver(post_save, sender=BookFormat, dispatch_uid="note_format_change@BookFormat")
+@receiver(post_delete, sender=BookFormat, dispatch_uid="note_format_change@BookFormat")
+@receiver(post_save, sender=BookReseller, dispatch_uid="note_format_change@BookReseller")
+@receiver(post_delete, sender=BookReseller, dispatch_uid="note_format_change@BookReseller")
+def note_format_change(sender, **kwargs):
+    # book pages list formats and resellers, which have no modified date; bookstore.conditional reads this
+    if not Watermark.objects.filter(name='book_formats').update(updated=datetime.now()):
+        Watermark.objects.create(name='book_formats')
+
+@receiver(post_save, sender=BookPrice, dispatch_uid="forget_book_prices@BookPrice")
+@receiver(post_delete, sender=BookPrice, dispatch_uid="forget_book_prices@BookPrice")
+def forget_book_prices(sender, **kwargs):
+    instance = kwargs.get('instance')
+    if instance:
+        cache.delete(PRICE_CACHE_KEY % instance.book_id)
+
+@receiver(m2m_changed, sender=MergedUser.accounts.through, dispatch_uid="forget_merged_accounts@MergedUser")
+@receiver(pre_delete, sender=MergedUser, dispatch_uid="forget_merged_accounts@MergedUser")
+def forget_merged_accounts(sender, **kwargs):
+    # pk_set holds added or removed accounts; the group's current accounts see the change too
+    merged = kwargs['instance']
+    if kwargs.get('action', 'pre_delete') not in ('pre_delete', 'post_add', 'post_remove', 'pre_clear'):
+        return
+    ids = set(merged.accounts.values_list('pk', flat=True))
+    ids.update(kwargs.get('pk_set') or ())
+    cache.delete_many([MERGED_CACHE_KEY % id for id in ids])
+
+SIDEBAR_FRAGMENTS = {
+    Genre: ('genre_sidebar',),
+    Person: ('author_sidebar',),
+    SitePage: ('site_headnav', 'site_footnav'),
+}
+
+@receiver(post_save, sender=Genre, dispatch_uid="forget_sidebar_fragments@Genre")
+@receiver(post_delete, sender=Genre, dispatch_uid="forget_sidebar_fragments@Genre")
+@receiver(post_save, sender=Person, dispatch_uid="forget_sidebar_fragments@Person")
+@receiver(post_delete, sender=Person, dispatch_uid="forget_sidebar_fragments@Person")
+@receiver(post_save, sender=SitePage, dispatch_uid="forget_sidebar_fragments@SitePage")
+@receiver(post_delete, sender=SitePage, dispatch_uid="forget_sidebar_fragments@SitePage")
+def forget_sidebar_fragments(sender, **kwargs):
+    forget_fragments(*SIDEBAR_FRAGMENTS[sender])
+
+@receiver(pre_save, sender=BookPublication, dispatch_uid="hash_publication@BookPublication")
+def hash_publication(sender, **kwargs):
+    pub = kwargs['instance']
+    # hash new uploads before the file field saves them, and older rows on their next save
+    if pub.data and (not pub.data._committed or not pub.data_hash):
+        pub.hash_data()
@@ -0,0 +1,65 @@
+# bookstore email outbox
+#
+# Purchase emails are queued as PurchaseEmail rows when a purchase becomes
+# ready, and sent from outside the request by `manage.py send_outbox`.
+from django.core.mail import get_connection
+
+from bookstore.models import Purchase, PurchaseEmail
+
+from datetime import datetime, timedelta
+import logging
+
+MAX_ATTEMPTS = 10
+
+def retry_delay(attempts):
+    """wait after the given number of failed attempts: 2, 4, 8 minutes... up to a day"""
+    return timedelta(minutes=min(2 ** attempts, 24 * 60))
+
+def send_queued(batch_size=50, connection=None):
+    """Send up to batch_size due emails over one connection; return (sent, failed)"""
+    now = datetime.now()
+    queued = list(PurchaseEmail.objects.filter(sent__isnull=True, attempts__lt=MAX_ATTEMPTS,
+        next_attempt__lte=now).select_related('purchase__publication__book')[:batch_size])
+    if not queued:
+        return 0, 0
+
+    connection = connection or get_connection()
+    sent = failed = 0
+    try:
+        connection.open()
+    except Exception:
+        logging.exception("Purchase Email connection")
+        return sent, len(queued)
+    try:
+        for email in queued:
+            purchase = email.purchase
+            try:
+                if purchase.email_sent:
+                    # sent some other way since it was queued
+                    PurchaseEmail.objects.filter(pk=email.pk).update(sent=purchase.email_sent_date or now)
+                    continue
+                message = purchase.email_message()
+                message.connection = connection
+                message.send()
+            except Exception, e:
+                logging.exception("Purchase Email %s" % purchase.pk)
+                failed += 1
+                email.attempts += 1
+                PurchaseEmail.objects.filter(pk=email.pk).update(attempts=email.attempts,
+                    next_attempt=datetime.now() + retry_delay(email.attempts), last_error=str(e)[:1000])
+                # don't reuse a connection that may have failed mid-conversation
+                connection.close()
+                try:
+                    connection.open()
+                except Exception:
+                    logging.exception("Purchase Email connection")
+                    break
+                continue
+            sent += 1
+            done = datetime.now()
+            # update() so the purchase's post_save handlers don't run again
+            Purchase.objects.filter(pk=purchase.pk).update(email_sent=True, email_sent_date=done)
+            PurchaseEmail.objects.filter(pk=email.pk).update(sent=done, attempts=email.attempts + 1)
+    finally:
+        connection.close()
+    return sent, failed
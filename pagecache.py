@@ -0,0 +1,61 @@
+# bookstore page cache
+#
+# Pages rendered for anonymous visitors are cached whole, with the versions of
+# the tags noted while they rendered (see bookstore.caching.depend_on).
+# Saving catalog rows forgets their tags, so a page showing them is rendered
+# afresh on its next request. Pages are cached under the day's date and kept
+# until midnight, when upcoming books become published.
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.functional import wraps
+
+from bookstore import caching
+
+from datetime import datetime, timedelta
+import hashlib
+import time
+
+PAGE_CACHE_KEY = 'bookstore.page.%s'
+
+def page_key(request, today):
+    url = "%s|%s|%s" % (today, request.get_host(), request.get_full_path())
+    return PAGE_CACHE_KEY % hashlib.md5(url).hexdigest()
+
+def seconds_until_midnight(now):
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return max((midnight - now).seconds, 1)
+
+def cache_anonymous_page(view):
+    """Serve the view's pages to anonymous visitors from the cache while the data they show is unchanged"""
+    name = 'page_%s' % view.__name__
+
+    def cached_view(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or request.user.is_authenticated():
+            return view(request, *args, **kwargs)
+        now = datetime.now()
+        key = page_key(request, now.date())
+        entry = cache.get(key)
+        if entry is not None:
+            if caching.tags_current(entry['tags']):
+                caching.count(name, 'hit')
+                return HttpResponse(entry['content'], content_type=entry['content_type'])
+            caching.count(name, 'stale')
+        caching.count(name, 'miss')
+
+        started = time.time()
+        caching.begin_dependencies()
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            tags = caching.end_dependencies()
+        if response.status_code != 200 or response.cookies:
+            return response
+        versions = caching.tag_versions(tags, started)
+        if versions is None:
+            # something the page shows changed while it rendered
+            caching.count(name, 'changed')
+        else:
+            cache.set(key, dict(content=response.content, content_type=response['Content-Type'], tags=versions),
+                seconds_until_midnight(now))
+        return response
+    return wraps(view)(cached_view)
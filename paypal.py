@@ -0,0 +1,141 @@
+# bookstore PayPal IPN processing
+#
+# paypal_ipn only queues notifications. `manage.py process_ipn` verifies them
+# with PayPal in batches over reused connections, then applies them in order.
+# Point BOOKSTORE_PAYPAL_VERIFY_URL at a stub server to test without PayPal.
+from django.conf import settings
+
+from bookstore.models import PaypalIpn
+
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import Queue
+import httplib
+import logging
+import socket
+import urlparse
+
+PAYPAL = getattr(settings, 'BOOKSTORE_PAYPAL_URL', "https://www.paypal.com/cgi-bin/webscr")
+# PAYPAL = "https://www.sandbox.paypal.com/cgi-bin/webscr" # sandbox
+PAYPAL_VERIFY = getattr(settings, 'BOOKSTORE_PAYPAL_VERIFY_URL', PAYPAL)
+
+# PayPal's answers to a verification request; anything else means try again later
+VERDICTS = ('VERIFIED', 'INVALID')
+
+class VerificationError(Exception):
+    pass
+
+# txn_type values that pay for a purchase
+PAYMENT_TYPES = ('cart', 'express_checkout', 'masspay', 'virtual_terminal', 'web_accept')
+
+class VerifierPool(object):
+    """Keep-alive connections to the IPN verification url, shared between threads"""
+
+    def __init__(self, url=None, size=4, timeout=30):
+        parts = urlparse.urlsplit(url or PAYPAL_VERIFY)
+        self.connection_class = parts.scheme == 'https' and httplib.HTTPSConnection or httplib.HTTPConnection
+        self.netloc = parts.netloc
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self.timeout = timeout
+        self.idle = Queue.Queue(size)
+
+    def verify(self, params):
+        """PayPal's verdict on params: 'VERIFIED' or 'INVALID'; raise VerificationError for any other answer"""
+        body = params + '&cmd=_notify-validate'
+        headers = {"Content-type": "application/x-www-form-urlencoded"}
+        for retry in (False, True):
+            try:
+                connection = self.idle.get_nowait()
+            except Queue.Empty:
+                connection = self.connection_class(self.netloc, timeout=self.timeout)
+            try:
+                connection.request('POST', self.path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if retry:
+                    raise
+                # the server may have dropped an idle connection; try once on a fresh one
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                try:
+                    self.idle.put_nowait(connection)
+                except Queue.Full:
+                    connection.close()
+            content = content.strip()
+            if response.status != 200 or content not in VERDICTS:
+                # an outage or maintenance page says nothing about the notification
+                raise VerificationError("HTTP %s: %r" % (response.status, content[:40]))
+            return content
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+def apply_ipn(ipn, verdict):
+    """Apply a verified notification to its purchase and record the outcome in ipn.state"""
+    purchase = ipn.purchase
+    params = dict(ipn.parse_params())
+    if verdict not in VERDICTS:
+        raise VerificationError("IPN %s: unexpected verdict %r" % (ipn.pk, str(verdict)[:40]))
+    if verdict == 'INVALID':
+        logging.error("IPN %s: Paypal claims: %s", ipn.pk, str(verdict)[:40])
+        ipn.state = 'I'
+    elif ipn.txn_id and PaypalIpn.objects.filter(txn_id=ipn.txn_id, payment_status=ipn.payment_status,
+            state='A').exclude(pk=ipn.pk).exists():
+        # PayPal resends notifications until it sees a response; only the first counts
+        ipn.state = 'D'
+    elif purchase.price > ipn.payment:
+        logging.error("IPN %s: Payment %s smaller than Price %s" % (ipn.pk, ipn.payment, purchase.price))
+        ipn.state = 'B'
+    else:
+        if ipn.payment_status == "Completed":
+            if purchase.status != 'R' and params.get('txn_type') in PAYMENT_TYPES:
+                purchase.status = 'R'
+                if not purchase.email_sent:
+                    purchase.email_name = params.get('first_name') or params.get('last_name') or 'Lillibridge Press Customer'
+                    purchase.email_address = params.get('payer_email') or purchase.customer.email
+                    purchase.email_link = ipn.download_link
+                purchase.save()
+        ipn.state = 'A'
+    ipn.processed = datetime.now()
+    PaypalIpn.objects.filter(pk=ipn.pk).update(state=ipn.state, processed=ipn.processed)
+
+def process_queued(batch_size=100, pool=None, threads=4):
+    """Verify and apply up to batch_size queued notifications; return how many were handled"""
+    ipns = list(PaypalIpn.objects.filter(state='Q').order_by('entered', 'id').select_related('purchase')[:batch_size])
+    if not ipns:
+        return 0
+
+    own_pool = pool is None
+    pool = pool or VerifierPool(size=threads)
+    def verify(ipn):
+        try:
+            return pool.verify(ipn.params)
+        except Exception:
+            logging.exception("IPN %s: verification failed" % ipn.pk)
+            return None
+    workers = ThreadPool(threads)
+    try:
+        verdicts = workers.map(verify, ipns)
+    finally:
+        workers.close()
+        if own_pool:
+            pool.close()
+
+    handled = 0
+    for ipn, verdict in zip(ipns, verdicts):
+        if verdict not in VERDICTS:
+            # left queued for the next run
+            continue
+        apply_ipn(ipn, verdict)
+        handled += 1
+    return handled
@@ -0,0 +1,90 @@
+# bookstore site picks
+#
+# site_picks shows a random visible bestseller and a random featured book on
+# every page. The ids to choose from are kept in each process as pools with
+# cumulative weights, so a pick is a bisect and the books are fetched by
+# primary key. The bestsellers are the month's list from bookstore.bestsellers
+# and the books flagged as bestsellers, weighted by their sales. Saving a book
+# that joins or leaves a pool, or a new bestseller list, forgets the 'picks'
+# tag, and each process rebuilds its pools when it sees the tag has moved on;
+# they are also rebuilt hourly.
+from django.core.cache import cache
+
+from bookstore.models import Book, BookSales
+from bookstore.caching import TAG_CACHE_KEY, count
+from bookstore.bestsellers import top_books
+
+from bisect import bisect_left, bisect_right
+import random
+import time
+
+POOL_SECONDS = 60 * 60
+SALES_WINDOW = 30
+
+class Pool(object):
+    """Ids to choose from, each with a weight"""
+    def __init__(self, weights):
+        self.ids = []
+        self.totals = []
+        total = 0
+        for id, weight in sorted(weights.items()):
+            if weight > 0:
+                total += weight
+                self.ids.append(id)
+                self.totals.append(total)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _span(self, id):
+        """(start, weight) of id's share of the total"""
+        i = bisect_left(self.ids, id)
+        if i == len(self.ids) or self.ids[i] != id:
+            return 0, 0
+        start = i and self.totals[i - 1] or 0
+        return start, self.totals[i] - start
+
+    def choose(self, exclude=None, random=random.random):
+        """A weighted random id other than exclude; None if there's nothing else to choose"""
+        total = self.totals and self.totals[-1] or 0
+        start, skipped = self._span(exclude)
+        if total - skipped <= 0:
+            return None
+        r = random() * (total - skipped)
+        if skipped and r >= start:
+            # step over exclude's share
+            r += skipped
+        return self.ids[min(bisect_right(self.totals, r), len(self.ids) - 1)]
+
+def build_pools():
+    """(bestseller pool, feature pool) from the visible books, bestsellers weighted by recent sales"""
+    books = Book.objects.filter(visible=True)
+    field = 'sales_%d' % SALES_WINDOW
+    top = dict(top_books(SALES_WINDOW))
+    # the list is ranked by bookstore.bestsellers, so a book may have been hidden since
+    bestsellers = dict((id, top[id]) for id in books.filter(pk__in=top.keys()).values_list('pk', flat=True))
+    sales = dict(BookSales.objects.filter(book__visible=True, book__bestseller=True).values_list('book', field))
+    for id in books.filter(bestseller=True).values_list('pk', flat=True):
+        bestsellers[id] = 1 + sales.get(id, 0)
+    features = dict((id, 1) for id in books.filter(feature=True).values_list('pk', flat=True))
+    return Pool(bestsellers), Pool(features)
+
+_pools = [None, None, 0]    # pools, the 'picks' tag version they were built at, when
+
+def get_pools():
+    version = cache.get(TAG_CACHE_KEY % 'picks')
+    pools, built_version, built = _pools
+    if pools is None or version != built_version or time.time() - built > POOL_SECONDS:
+        count('site_picks', 'miss')
+        _pools[:] = [build_pools(), version, time.time()]
+    else:
+        count('site_picks', 'hit')
+    return _pools[0]
+
+def site_picks():
+    """(bestseller, feature), different books when possible; either may be None"""
+    bestsellers, features = get_pools()
+    bestseller = bestsellers.choose()
+    feature = features.choose(exclude=bestseller)
+    books = Book.objects.filter(visible=True).in_bulk([id for id in (bestseller, feature) if id is not None])
+    return books.get(bestseller), books.get(feature)
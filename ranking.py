@@ -0,0 +1,125 @@
+# bookstore author ranking
+#
+# `manage.py rank_authors` keeps Person.rank, which orders the author sidebar,
+# as a score of purchases and downloads of each author's books that halves
+# every HALF_LIFE days. Each run reads only the activity since its
+# watermarks, downloads in ranges of ids, then decays every rank with one
+# update and adds the new scores with a CASE update per batch of authors.
+from django.db import connection, transaction
+from django.db.models import F
+
+from bookstore.models import Book, Person, Purchase, Download, Watermark
+from bookstore.caching import forget_fragments, forget_tags
+from bookstore.reports import SETTLE, get_watermark, set_watermark
+
+from datetime import datetime
+
+HALF_LIFE = 30.0    # days
+SALE_WEIGHT = 10.0
+DOWNLOAD_WEIGHT = 1.0
+DOWNLOAD_CHUNK = 50000
+UPDATE_CHUNK = 300  # authors per CASE update; three parameters each
+SIDEBAR_SIZE = 6
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+def decay(age):
+    """Weight of activity age, a timedelta, ago"""
+    return 0.5 ** ((age.days + age.seconds / 86400.0) / HALF_LIFE)
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def book_scores(now, until):
+    """Decayed scores by book for activity since the watermarks; return (scores, purchases, downloads)"""
+    scores = {}
+    # review copies are given away, not sold
+    purchases = Purchase.objects.filter(ready_date__lt=until).exclude(transaction='V')
+    since = get_watermark('rank.sales')
+    if since:
+        purchases = purchases.filter(ready_date__gte=datetime.strptime(since, TIME_FORMAT))
+    n_purchases = 0
+    for ready_date, book in purchases.values_list('ready_date', 'publication__book').iterator():
+        scores[book] = scores.get(book, 0.0) + SALE_WEIGHT * decay(now - ready_date)
+        n_purchases += 1
+    set_watermark('rank.sales', until.strftime(TIME_FORMAT))
+
+    last = int(get_watermark('rank.downloads', '0'))
+    n_downloads = 0
+    while True:
+        rows = list(Download.objects.filter(pk__gt=last, timestamp__lt=until).order_by('pk')
+            .values_list('pk', 'timestamp', 'purchase__publication__book')[:DOWNLOAD_CHUNK])
+        for pk, timestamp, book in rows:
+            scores[book] = scores.get(book, 0.0) + DOWNLOAD_WEIGHT * decay(now - timestamp)
+        n_downloads += len(rows)
+        if rows:
+            last = rows[-1][0]
+        if len(rows) < DOWNLOAD_CHUNK:
+            break
+    set_watermark('rank.downloads', str(last))
+    return scores, n_purchases, n_downloads
+
+def author_scores(scores):
+    """Book scores shared among each book's authors"""
+    authors = {}
+    for chunk in _chunks(scores.keys(), 500):
+        for book, person in Book.authors.through.objects.filter(book__in=chunk).values_list('book', 'person'):
+            authors.setdefault(book, []).append(person)
+    credits = {}
+    for book, people in authors.items():
+        for person in people:
+            credits[person] = credits.get(person, 0.0) + scores[book] / len(people)
+    return credits
+
+def add_ranks(credits):
+    """Add credits to the authors' ranks with a CASE update per batch"""
+    qn = connection.ops.quote_name
+    table, pk, rank = qn(Person._meta.db_table), qn(Person._meta.pk.column), qn('rank')
+    cursor = connection.cursor()
+    for chunk in _chunks(sorted(credits.items()), UPDATE_CHUNK):
+        params = []
+        for id, credit in chunk:
+            params.extend((id, credit))
+        params.extend(id for id, credit in chunk)
+        cursor.execute("UPDATE %s SET %s = %s + CASE %s %s ELSE 0 END WHERE %s IN (%s)" % (
+            table, rank, rank, pk, " ".join(["WHEN %s THEN %s"] * len(chunk)), pk, ", ".join(["%s"] * len(chunk))),
+            params)
+    transaction.set_dirty()
+
+def sidebar_authors():
+    return list(Person.objects.filter(author=True, visible=True).order_by('-rank').values_list('pk', flat=True)[:SIDEBAR_SIZE])
+
+@transaction.commit_on_success
+def _update_ranks():
+    now = datetime.now()
+    before = sidebar_authors()
+    scores, n_purchases, n_downloads = book_scores(now, now - SETTLE)
+
+    ranked = get_watermark('rank.time')
+    if ranked:
+        factor = decay(now - datetime.strptime(ranked, TIME_FORMAT))
+        Person.objects.filter(rank__gt=0).update(rank=F('rank') * factor)
+    add_ranks(author_scores(scores))
+    set_watermark('rank.time', now.strftime(TIME_FORMAT))
+
+    changed = sidebar_authors() != before
+    if changed:
+        # pages' validators read this (see bookstore.conditional)
+        set_watermark('author_ranks', now.strftime(TIME_FORMAT))
+    return n_purchases, n_downloads, changed
+
+def update_ranks():
+    """Bring author ranks up to now; return (purchases, downloads) added"""
+    n_purchases, n_downloads, changed = _update_ranks()
+    if changed:
+        # after the commit, so the sidebar isn't cached again from the old ranks
+        forget_fragments('author_sidebar')
+        forget_tags('person')
+    return n_purchases, n_downloads
+
+@transaction.commit_on_success
+def reset_ranks():
+    """Zero every rank and forget the watermarks, so the next update ranks all activity"""
+    Person.objects.update(rank=0.0)
+    Watermark.objects.filter(name__startswith='rank.').delete()
@@ -0,0 +1,132 @@
+# bookstore sales and download rollups
+#
+# `manage.py update_rollups` adds purchases that became ready, and downloads,
+# since its watermarks to daily SalesRollup and DownloadRollup rows. The
+# staff sales page reads only the rollups.
+from django.db import transaction
+from django.db.models import F, Sum
+
+from bookstore.models import Purchase, Download, Watermark, SalesRollup, DownloadRollup
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+# rows newer than this may belong to transactions that haven't committed yet;
+# they are left for the next run
+SETTLE = timedelta(minutes=5)
+
+def get_watermark(name, default=''):
+    try:
+        return Watermark.objects.get(name=name).value
+    except Watermark.DoesNotExist:
+        return default
+
+def set_watermark(name, value):
+    if not Watermark.objects.filter(name=name).update(value=value, updated=datetime.now()):
+        Watermark.objects.create(name=name, value=value)
+
+def _add(model, key, **counts):
+    """Add counts to the rollup row for key, creating it if needed"""
+    increments = dict((name, F(name) + n) for name, n in counts.items())
+    if not model.objects.filter(**key).update(**increments):
+        values = dict(key)
+        values.update(counts)
+        model.objects.create(**values)
+
+def _parse_datetime(value):
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+
+@transaction.commit_on_success
+def rollup_sales(until):
+    """Add purchases that became ready since the watermark; return how many"""
+    since = get_watermark('sales')
+    purchases = Purchase.objects.filter(ready_date__lt=until)
+    if since:
+        purchases = purchases.filter(ready_date__gte=_parse_datetime(since))
+    totals = {}
+    n = 0
+    for ready_date, book, format, currency, kind, price in purchases.values_list(
+            'ready_date', 'publication__book', 'publication__format', 'currency', 'transaction', 'price').iterator():
+        key = (ready_date.date(), book, format, currency, kind)
+        sales, revenue = totals.get(key, (0, Decimal(0)))
+        totals[key] = sales + 1, revenue + price
+        n += 1
+    for (day, book, format, currency, kind), (sales, revenue) in totals.items():
+        _add(SalesRollup, dict(day=day, book_id=book, format_id=format, currency=currency, transaction=kind),
+            sales=sales, revenue=revenue)
+    set_watermark('sales', until.strftime("%Y-%m-%d %H:%M:%S.%f"))
+    return n
+
+@transaction.commit_on_success
+def rollup_downloads(until):
+    """Add downloads recorded since the watermark; return how many"""
+    since = int(get_watermark('downloads', '0'))
+    downloads = Download.objects.filter(pk__gt=since, timestamp__lt=until).order_by('pk')
+    totals = {}
+    last = since
+    for pk, timestamp, book, format in downloads.values_list(
+            'pk', 'timestamp', 'purchase__publication__book', 'purchase__publication__format').iterator():
+        key = (timestamp.date(), book, format)
+        totals[key] = totals.get(key, 0) + 1
+        last = pk
+    for (day, book, format), count in totals.items():
+        _add(DownloadRollup, dict(day=day, book_id=book, format_id=format), downloads=count)
+    set_watermark('downloads', str(last))
+    return sum(totals.values())
+
+def update_rollups():
+    """Bring the rollups up to date; return (purchases, downloads) added"""
+    until = datetime.now() - SETTLE
+    return rollup_sales(until), rollup_downloads(until)
+
+@transaction.commit_on_success
+def rebuild_rollups():
+    """Clear the rollups and their watermarks, so the next update recounts everything.
+
+    Purchases that were ready, including those expired since, from before
+    ready_date was kept are dated by their purchase date.
+    """
+    Purchase.objects.filter(status__in=('R', 'X'), ready_date__isnull=True).update(ready_date=F('date'))
+    SalesRollup.objects.all().delete()
+    DownloadRollup.objects.all().delete()
+    Watermark.objects.filter(name__in=('sales', 'downloads')).delete()
+
+PAID_TRANSACTIONS = ('P', 'F')
+
+def sales_report(since=None):
+    """Totals from the rollups since the date given, or for all time"""
+    sales = SalesRollup.objects.all()
+    downloads = DownloadRollup.objects.all()
+    if since:
+        sales = sales.filter(day__gte=since)
+        downloads = downloads.filter(day__gte=since)
+
+    by_kind = sales.values('transaction', 'currency').annotate(
+        sales=Sum('sales'), revenue=Sum('revenue')).order_by('transaction', 'currency')
+    # review copies are given away and replacements reissue a sale; by_kind shows them
+    sales = sales.filter(transaction__in=PAID_TRANSACTIONS)
+    by_book = {}
+    for row in sales.values('book', 'book__title', 'currency').annotate(sales=Sum('sales'), revenue=Sum('revenue')):
+        book = by_book.setdefault(row['book'], dict(title=row['book__title'], sales=0, revenue={}, downloads=0))
+        book['sales'] += row['sales']
+        book['revenue'][row['currency']] = row['revenue']
+    for row in downloads.values('book', 'book__title').annotate(downloads=Sum('downloads')):
+        book = by_book.setdefault(row['book'], dict(title=row['book__title'], sales=0, revenue={}, downloads=0))
+        book['downloads'] = row['downloads']
+    by_day = {}
+    for row in sales.values('day').annotate(sales=Sum('sales')):
+        by_day.setdefault(row['day'], dict(day=row['day'], sales=0, downloads=0))['sales'] = row['sales']
+    for row in downloads.values('day').annotate(downloads=Sum('downloads')):
+        by_day.setdefault(row['day'], dict(day=row['day'], sales=0, downloads=0))['downloads'] = row['downloads']
+
+    kinds = dict(Purchase._meta.get_field('transaction').choices)
+    by_kind = list(by_kind)
+    for row in by_kind:
+        row['kind'] = kinds.get(row['transaction'], row['transaction'])
+    for book in by_book.values():
+        book['revenue'] = sorted(book['revenue'].items())
+    return dict(
+        by_kind=by_kind,
+        by_book=sorted(by_book.values(), key=lambda book: (-book['sales'], book['title'])),
+        by_day=sorted(by_day.values(), key=lambda day: day['day'], reverse=True),
+    )
@@ -0,0 +1,152 @@
+# bookstore slug routing
+#
+# Detail pages find their object through SlugRoute, which maps the lower
+# cased current and former links of books, authors, genres and site pages to
+# the object and its current link, so one indexed lookup tells a view which
+# object to show and whether to redirect. Routes are recorded when a link
+# changes (see route_links in bookstore.models), and looked up through a
+# short-lived cache in each process. A link without a route, such as one made
+# before `manage.py build_slug_routes` was run, is looked up the old way and
+# given a route.
+from django.db import IntegrityError, transaction
+
+from bookstore.models import SlugRoute, ROUTE_MODELS, route_link
+from bookstore.caching import count
+
+import time
+
+ROUTE_CACHE_SECONDS = 60
+ROUTE_CACHE_SIZE = 10000
+
+# links from the store's old site
+migrate_books = dict(
+    Still_Life="still-life",
+    Under_the_Hooked_Cross="under-hooked-cross",
+    The_Body_Servant_of_Aleops="body-servant-aleops",
+    Body_Servant_of_Aleops="body-servant-aleops",
+    venus_loop_tom_olbert="venus-loop",
+    stockwood_street="stockwood-street",
+    The_Last_Ride_ofthe_Reverse_Cowgirls="last-ride-reverse-cowgirls",
+    In_the_Dunes="dunes",
+    The_Zombie_Attached_To_My_Head="zombie-attached-my-head",
+    Sallowed_Blood="sallowed-blood",
+    A_Violin_s_Cry="violins-cry",
+    violin_s_cry="violins-cry",
+    Autumn_s_Spirit="autumns-spirit",
+    The_Last_Guardian="last-guardian",
+    Rune_Song="rune-song",
+    the_lovers="lovers-tale-prehistoric-ain-sakhri-figurine",
+    To_the_Highest_Bidder="highest-bidder",
+    Beautiful_Cruelty="beautiful-cruelty",
+
+    Science_Fiction="science-fiction",
+    Horror_Gothic="horror-and-gothic",
+    magick_occult="magick-and-occult",
+    magic_occult="magick-and-occult",
+    young_adult="young-adult",
+    Myths_Tales="myths-and-tales",
+    myth="myths-and-tales",
+    superhero="Superheroes",
+    free_read="free-read",
+)
+
+migrate_authors = {
+    "John_Anderson": "john-anderson",
+    "natasha_bennet": "natasha-bennet",
+    "RE_Blakeslee": "re-blakeslee",
+    "Jordan_Brewer": "jordan-brewer",
+    "DJ_Cockburn": "dj-cockburn",
+    "Joseph_Cox": "joseph-cox",
+    "John_Leahy": "john-leahy",
+    "Ellen_Lett": "ellen-lett",
+    "lydia_nyx": "lydia-nyx",
+    "George_OGorman": "george-ogorman",
+    "George_O%26Gorman": "george-ogorman",
+    "Tom_Olbert": "tom-olbert",
+    "DC_Petterson": "dc-petterson",
+    "DCPetterson": "dc-petterson",
+    "Jaiden_Robert": "jaiden-robert",
+    "Glenn_Stuart": "glenn-stuart",
+    "I_Writer": "i-writer",
+}
+
+migrate_genres = dict(
+    Science_Fiction="science-fiction",
+    Horror_Gothic="horror-and-gothic",
+    magick_occult="magick-and-occult",
+    magic_occult="magick-and-occult",
+    Young_Adult="young-adult",
+    Myths_Tales="myths-and-tales",
+    myth="myths-and-tales",
+    superhero="Superheroes",
+    free_reads="free-read",
+)
+
+migrate_pages = dict(
+    about="about-us",
+)
+
+LEGACY_LINKS = dict(book=migrate_books, author=migrate_authors, genre=migrate_genres, page=migrate_pages)
+KIND_MODELS = dict((kind, model) for model, kind in ROUTE_MODELS.items())
+
+_routes = {}    # (kind, slug) -> (time looked up, (object id, current link))
+
+def forget_routes():
+    _routes.clear()
+
+def _find(kind, link):
+    """(object id, current link) for link the way it was found before routes, or None"""
+    model = KIND_MODELS[kind]
+    for candidate in (link, LEGACY_LINKS[kind].get(link)):
+        if not candidate:
+            continue
+        found = list(model.objects.filter(link__iexact=candidate).values_list('pk', 'link')[:1])
+        if found:
+            return found[0]
+    return None
+
+def resolve(kind, link):
+    """(object id, current link) for a current or former link, or None"""
+    key = (kind, link.lower())
+    now = time.time()
+    cached = _routes.get(key)
+    if cached and now - cached[0] < ROUTE_CACHE_SECONDS:
+        count('slug_routes', 'hit')
+        return cached[1]
+    count('slug_routes', 'miss')
+    found = list(SlugRoute.objects.filter(kind=kind, slug=key[1]).values_list('object_id', 'link')[:1])
+    if found:
+        found = found[0]
+    else:
+        found = _find(kind, link)
+        if not found:
+            return None
+        count('slug_routes', 'healed')
+        # in a savepoint, so a failed insert doesn't abort the request's transaction
+        sid = transaction.savepoint()
+        try:
+            route_link(kind, link, *found)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # routed by another request meanwhile
+            transaction.savepoint_rollback(sid)
+    if len(_routes) >= ROUTE_CACHE_SIZE:
+        _routes.clear()
+    _routes[key] = (now, found)
+    return found
+
+def build_routes():
+    """Route every current link, and the old site's links; return how many routes were written"""
+    written = 0
+    for model, kind in ROUTE_MODELS.items():
+        for pk, link in model.objects.values_list('pk', 'link'):
+            SlugRoute.objects.filter(kind=kind, object_id=pk).exclude(link=link).update(link=link)
+            route_link(kind, link, pk, link)
+            written += 1
+        for old, link in LEGACY_LINKS[kind].items():
+            found = list(model.objects.filter(link__iexact=link).values_list('pk', 'link')[:1])
+            if found and not SlugRoute.objects.filter(kind=kind, slug=old.lower()).exists():
+                route_link(kind, old, *found[0])
+                written += 1
+    forget_routes()
+    return written
@@ -0,0 +1,367 @@
+# bookstore catalog search
+#
+# SearchIndex is an inverted index over each book's title, authors, genres,
+# blurb and description, ranked with BM25. It is kept free of django imports
+# so it can be benchmarked on its own:
+#   python bench_search.py
+#
+# `manage.py update_search_index` reindexes books whose modified date moved
+# since the last run, and saves the index; web processes reload the saved file
+# when it changes. Saving a book or its parts, or renaming one of its authors
+# or genres, updates the book's modified date.
+from array import array
+from bisect import bisect_left
+from heapq import nlargest
+from operator import itemgetter
+import errno
+import math
+import marshal
+import os
+import re
+import time
+import unicodedata
+import zlib
+
+# (field, weight): a word in the title counts as much as three in the blurb
+FIELDS = (
+    ('title', 3.0),
+    ('authors', 2.0),
+    ('genres', 1.5),
+    ('blurb', 1.0),
+    ('description', 0.5),
+)
+K1 = 1.2
+B = 0.75
+PREFIX_WEIGHT = 0.7     # a word that only starts with the query word
+MAX_EXPANSIONS = 50     # most frequent words tried for a prefix
+RESULTS_CACHED = 500    # searches remembered between changes
+
+STOPWORDS = frozenset(u"a an and are as at be but by for from has have her his in into is it its of on or she that the their them they this to was were will with".split())
+
+_markup = re.compile(r"\[(?:url|go|goto|a|color|youtube):[^|\]]*\|?|\w+://\S+|www\.\S+", re.UNICODE)
+_combining = re.compile(u"[\u0300-\u036f]")
+_word = re.compile(r"[^\W_]+", re.UNICODE)
+
+def tokenize(text):
+    """Lowercased words of text, without accents, minifmt link targets, or urls"""
+    text = _markup.sub(u" ", text)
+    text = _combining.sub(u"", unicodedata.normalize('NFKD', text).lower())
+    return _word.findall(text)
+
+class SearchIndex(object):
+    def __init__(self):
+        self.docs = {}          # doc id -> its distinct words, space separated and compressed
+        self.lengths = {}       # doc id -> weighted word count
+        self.versions = {}      # doc id -> the version given to add, such as a modified date
+        self.postings = {}      # word -> {doc id: weighted count}, or packed; see _pack
+        self.words = []         # for prefix lookups; sorted before use when words_sorted is False
+        self.words_sorted = True
+        self.total = 0.0        # sum of lengths
+        self.watermark = ''     # set by the caller; saved with the index
+        self._packed = set()    # words whose postings are still packed as loaded
+        self._norms = None      # doc id -> BM25 length normalization, until the index changes
+        self._results = {}      # recent searches, until the index changes
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, doc):
+        return doc in self.docs
+
+    def add(self, doc, fields, version=None):
+        """Index doc, replacing any earlier version; fields maps names in FIELDS to text"""
+        self.remove(doc)
+        counts = {}
+        length = 0.0
+        for name, weight in FIELDS:
+            for word in tokenize(fields.get(name) or u""):
+                length += weight
+                if word not in STOPWORDS:
+                    counts[word] = counts.get(word, 0.0) + weight
+        for word, count in counts.iteritems():
+            postings = self._postings(word)
+            if postings is None:
+                postings = self.postings[word] = {}
+                self.words.append(word)
+                self.words_sorted = False
+            postings[doc] = count
+        self.docs[doc] = zlib.compress(u" ".join(counts).encode('utf-8'))
+        self.lengths[doc] = length
+        self.versions[doc] = version
+        self.total += length
+        self._changed()
+
+    def remove(self, doc):
+        words = self.docs.pop(doc, None)
+        if words is None:
+            return
+        for word in zlib.decompress(words).decode('utf-8').split():
+            postings = self._postings(word)
+            del postings[doc]
+            if not postings:
+                del self.postings[word]
+                self._sort_words()
+                del self.words[bisect_left(self.words, word)]
+        self.total -= self.lengths.pop(doc)
+        del self.versions[doc]
+        self._changed()
+
+    def _postings(self, word):
+        postings = self.postings.get(word)
+        if word in self._packed:
+            self._packed.discard(word)
+            ids, halves = array('i'), array('H')
+            ids.fromstring(postings[0])
+            halves.fromstring(postings[1])
+            postings = self.postings[word] = dict(zip(ids, [h / 2.0 for h in halves]))
+        return postings
+
+    def _changed(self):
+        self._norms = None
+        self._results = {}
+
+    def _sort_words(self):
+        if not self.words_sorted:
+            self.words.sort()
+            self.words_sorted = True
+
+    def _count(self, word):
+        """How many docs contain word, without unpacking its postings"""
+        postings = self.postings[word]
+        if word in self._packed:
+            return len(postings[0]) // array('i').itemsize
+        return len(postings)
+
+    def _expand(self, word, prefix):
+        """(word, weight) pairs for the indexed words a query word matches"""
+        matches = []
+        if word in self.postings:
+            matches.append((word, 1.0))
+        if prefix or not matches:
+            self._sort_words()
+            i = bisect_left(self.words, word)
+            found = []
+            while i < len(self.words) and self.words[i].startswith(word):
+                if self.words[i] != word:
+                    found.append(self.words[i])
+                i += 1
+            if len(found) > MAX_EXPANSIONS:
+                found = nlargest(MAX_EXPANSIONS, found, key=self._count)
+            matches.extend((w, PREFIX_WEIGHT) for w in found)
+        return matches
+
+    def search(self, query, limit=100):
+        """Up to limit (score, doc id) pairs for docs matching every word of query, best first.
+
+        The last word also matches longer words that start with it, unless
+        query ends with a space; so does any word that matches nothing as typed.
+        """
+        key = (query, limit)
+        if key not in self._results:
+            if len(self._results) >= RESULTS_CACHED:
+                self._results = {}
+            self._results[key] = self._search(query, limit)
+        return self._results[key]
+
+    def _search(self, query, limit):
+        words = tokenize(query)
+        if not words or not self.docs:
+            return []
+        last = len(words) - 1
+        terms = []
+        for i, word in enumerate(words):
+            if word in STOPWORDS and len(words) > 1:
+                continue
+            matches = [(self._postings(w), weight) for w, weight in
+                self._expand(word, i == last and not query[-1:].isspace())]
+            if not matches:
+                return []
+            terms.append(matches)
+        if not terms:
+            return []
+
+        n = len(self.docs)
+        norms = self._norms
+        if norms is None:
+            average = self.total / n or 1.0
+            norms = self._norms = dict((doc, K1 * (1.0 - B + B * length / average))
+                for doc, length in self.lengths.iteritems())
+        def score(matches, docs):
+            """Scores for docs from one query word, or for all its docs if docs is None"""
+            scores = {}
+            get = scores.get
+            for postings, weight in matches:
+                idf = weight * (K1 + 1.0) * math.log(1.0 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                if docs is None and not scores:
+                    # the usual case, and the most docs to score; a comprehension is quicker
+                    scores = dict((doc, idf * count / (count + norms[doc])) for doc, count in postings.iteritems())
+                    get = scores.get
+                    continue
+                if docs is None or len(postings) < len(docs):
+                    items = postings.iteritems()
+                    if docs is not None:
+                        items = ((doc, count) for doc, count in items if doc in docs)
+                else:
+                    items = ((doc, postings[doc]) for doc in docs if doc in postings)
+                for doc, count in items:
+                    scores[doc] = get(doc, 0.0) + idf * count / (count + norms[doc])
+            return scores
+
+        # rarest word first, so the others only score docs already matched
+        terms.sort(key=lambda matches: sum(len(postings) for postings, weight in matches))
+        scores = score(terms[0], None)
+        for matches in terms[1:]:
+            if not scores:
+                break
+            more = score(matches, scores)
+            scores = dict((doc, scores[doc] + s) for doc, s in more.iteritems())
+        best = nlargest(limit, scores.iteritems(), key=itemgetter(1))
+        return sorted(((s, doc) for doc, s in best), key=lambda (s, doc): (-s, doc))
+
+    @staticmethod
+    def _pack(postings):
+        """Doc ids and weighted counts as two strings of machine integers.
+
+        FIELDS weights are multiples of one half, so counts are stored in halves.
+        """
+        ids = array('i', postings.keys())
+        halves = array('H', [min(int(count * 2), 0xffff) for count in postings.values()])
+        return ids.tostring(), halves.tostring()
+
+    def dumps(self):
+        postings = {}
+        for word, docs in self.postings.iteritems():
+            if word in self._packed:
+                postings[word] = docs
+            else:
+                postings[word] = self._pack(docs)
+        return marshal.dumps((1, self.watermark, self.docs, self.lengths, self.versions, postings))
+
+    @classmethod
+    def loads(cls, data):
+        format, watermark, docs, lengths, versions, postings = marshal.loads(data)
+        index = cls()
+        index.watermark, index.docs, index.lengths, index.versions, index.postings = \
+            watermark, docs, lengths, versions, postings
+        index.words = sorted(postings)
+        index.total = sum(lengths.itervalues())
+        # postings are unpacked when first searched or changed
+        index._packed = set(postings)
+        return index
+
+    def save(self, path):
+        partial = path + '.part'
+        f = open(partial, 'wb')
+        try:
+            f.write(self.dumps())
+        finally:
+            f.close()
+        os.rename(partial, path)
+
+    @classmethod
+    def load(cls, path):
+        f = open(path, 'rb')
+        try:
+            return cls.loads(f.read())
+        finally:
+            f.close()
+
+#
+# The catalog's index
+#
+SETTLE_SECONDS = 5 * 60     # reread books modified this long before the watermark
+CHECK_INTERVAL = 10
+CHUNK_SIZE = 500
+
+def index_path():
+    from django.conf import settings
+    return getattr(settings, 'BOOKSTORE_SEARCH_INDEX',
+        os.path.join(settings.MEDIA_ROOT, 'bookstore', 'search.idx'))
+
+_index = [None, None, 0]    # index, its file's mtime, last checked
+
+def get_index():
+    """The saved index, reloaded when update_search_index saves a newer one"""
+    index, mtime, checked = _index
+    now = time.time()
+    if index is None or now - checked > CHECK_INTERVAL:
+        _index[2] = now
+        try:
+            current = os.path.getmtime(index_path())
+        except OSError:
+            current = None
+        if index is None or current != mtime:
+            _index[0] = current and SearchIndex.load(index_path()) or SearchIndex()
+            _index[1] = current
+    return _index[0]
+
+def search_books(query, limit=240):
+    """Ids of visible books matching query, best first"""
+    return [doc for score, doc in get_index().search(query, limit)]
+
+def book_fields(book_ids):
+    """Map the ids of visible books among book_ids to their fields for SearchIndex.add, and modified date"""
+    from bookstore.models import Book
+    fields = {}
+    for id, title, blurb, description, modified in Book.objects.filter(pk__in=book_ids, visible=True) \
+            .values_list('id', 'title', 'blurb', 'description', 'modified'):
+        fields[id] = dict(title=title, blurb=blurb, description=description, authors=u"", genres=u"",
+            modified=modified)
+    for book, firstname, lastname in Book.authors.through.objects.filter(book__in=fields.keys()) \
+            .values_list('book', 'person__firstname', 'person__lastname'):
+        fields[book]['authors'] += u" %s %s" % (firstname, lastname)
+    for book, name in Book.genres.through.objects.filter(book__in=fields.keys()).values_list('book', 'genre__name'):
+        fields[book]['genres'] += u" " + name
+    return fields
+
+def update_index(rebuild=False):
+    """Reindex books modified since the saved index was made; return (indexed, removed)"""
+    from bookstore.models import Book
+    import fcntl
+    from datetime import datetime, timedelta
+
+    path = index_path()
+    lock = open(path + '.lock', 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        index = None
+        if not rebuild:
+            try:
+                index = SearchIndex.load(path)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        started = datetime.now()
+        books = Book.objects.all()
+        if index is None:
+            index = SearchIndex()
+        elif index.watermark:
+            since = datetime.strptime(index.watermark, "%Y-%m-%d %H:%M:%S") - timedelta(seconds=SETTLE_SECONDS)
+            books = books.filter(modified__gte=since)
+        # books modified just before the watermark are reread, but only reindexed if they changed
+        changed = [id for id, modified in books.values_list('id', 'modified')
+            if index.versions.get(id) != str(modified)]
+        gone = set(index.docs).difference(Book.objects.values_list('id', flat=True))
+
+        indexed = 0
+        for i in range(0, len(changed), CHUNK_SIZE):
+            chunk = changed[i:i + CHUNK_SIZE]
+            fields = book_fields(chunk)
+            for id in chunk:
+                if id in fields:
+                    modified = fields[id].pop('modified')
+                    index.add(id, fields[id], str(modified))
+                    indexed += 1
+                elif id in index:
+                    # hidden
+                    gone.add(id)
+        for id in gone:
+            index.remove(id)
+        removed = len(gone)
+        if indexed or removed or not index.watermark:
+            index.watermark = started.strftime("%Y-%m-%d %H:%M:%S")
+            index.save(path)
+        return indexed, removed
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
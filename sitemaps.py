@@ -0,0 +1,266 @@
+# bookstore sitemaps
+#
+# `manage.py build_sitemaps` writes the sitemap as gzipped shards of at most
+# SHARD_SIZE urls, one kind of page per shard by ranges of ids, and a sitemap
+# index listing them. Each run rereads only the rows modified since its
+# watermark and rewrites only the shards whose contents changed. The sitemap
+# view sends the saved files with their ETag and Last-Modified, and answers
+# 404 until the command has first run.
+#
+# Urls are absolute, from BOOKSTORE_SITE_URL or else the current Site's domain.
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, Http404
+from django.utils import simplejson
+
+from bookstore.models import Genre, Person, Book, SitePage
+
+from cStringIO import StringIO
+from datetime import date, datetime, timedelta
+from xml.sax.saxutils import escape
+import errno
+import gzip
+import hashlib
+import os
+
+SHARD_SIZE = 50000      # the most urls a sitemap file may hold
+SETTLE = timedelta(minutes=5)   # reread rows modified this long before the watermark
+
+def _book_entry(book, today):
+    if book.publish_date <= today:
+        return book.get_absolute_url(), book.modified, 'monthly', '0.8'
+    return book.get_absolute_url(), book.modified, 'weekly', '0.7'
+
+# (kind, model, fields read, filter for the rows listed, entry for a row as (url, lastmod, changefreq, priority))
+KINDS = (
+    ('pages', SitePage, ('link', 'frontpage', 'modified'), dict(visible=True, frontpage=False),
+        lambda page, today: (page.get_absolute_url(), page.modified, 'monthly', '0.7')),
+    ('books', Book, ('link', 'publish_date', 'modified'), dict(visible=True), _book_entry),
+    ('authors', Person, ('link', 'modified'), dict(visible=True, author=True),
+        lambda author, today: (author.get_absolute_url(), author.modified, 'monthly', '0.6')),
+    ('genres', Genre, ('link', 'modified'), dict(visible=True),
+        lambda genre, today: (genre.get_absolute_url(), genre.modified, 'weekly', '0.5')),
+)
+
+def sitemap_root():
+    return getattr(settings, 'BOOKSTORE_SITEMAP_ROOT',
+        os.path.join(settings.MEDIA_ROOT, 'bookstore', 'sitemaps'))
+
+def site_url():
+    url = getattr(settings, 'BOOKSTORE_SITE_URL', None)
+    if not url:
+        from django.contrib.sites.models import Site
+        url = "http://%s" % Site.objects.get_current().domain
+    return url.rstrip('/')
+
+def shard_name(kind, pk):
+    return "%s-%d" % (kind, pk // SHARD_SIZE)
+
+def file_path(name):
+    """Where the sitemap file name, a shard or None for the index, is saved"""
+    return os.path.join(sitemap_root(), "%s.xml.gz" % (name and "sitemap-" + name or "sitemap"))
+
+def _fixed_entries():
+    # listed first in the pages shard
+    return [
+        (reverse('bookstore.views.storefront'), None, 'daily', '0.9'),
+        (reverse('bookstore.views.coming_soon'), None, 'daily', '0.6'),
+    ]
+
+def shard_entries(name, today):
+    kind, n = name.rsplit('-', 1)
+    n = int(n)
+    for k, model, fields, filters, entry in KINDS:
+        if k == kind:
+            break
+    entries = kind == 'pages' and n == 0 and _fixed_entries() or []
+    rows = model.objects.filter(pk__gte=n * SHARD_SIZE, pk__lt=(n + 1) * SHARD_SIZE, **filters)
+    for row in rows.only(*fields).order_by('pk').iterator():
+        entries.append(entry(row, today))
+    return entries
+
+def render_urlset(root, entries):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for url, lastmod, changefreq, priority in entries:
+        lines.append('  <url>')
+        lines.append('    <loc>%s</loc>' % escape(root + url))
+        if lastmod:
+            lines.append('    <lastmod>%s</lastmod>' % lastmod.strftime("%Y-%m-%d"))
+        lines.append('    <changefreq>%s</changefreq>' % changefreq)
+        lines.append('    <priority>%s</priority>' % priority)
+        lines.append('  </url>')
+    lines.append('</urlset>\n')
+    return u'\n'.join(lines).encode('utf-8')
+
+def render_index(root, shards):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+    for name in sorted(shards):
+        lines.append('  <sitemap>')
+        lines.append('    <loc>%s</loc>' % escape(root + reverse('bookstore.views.sitemap', kwargs=dict(shard=name))))
+        if shards[name]['lastmod']:
+            lines.append('    <lastmod>%s</lastmod>' % shards[name]['lastmod'])
+        lines.append('  </sitemap>')
+    lines.append('</sitemapindex>\n')
+    return u'\n'.join(lines).encode('utf-8')
+
+def write_file(name, xml, old):
+    """Save xml as the file name unless it's unchanged; return (manifest entry, whether it was written)"""
+    etag = hashlib.md5(xml).hexdigest()
+    if old and old['etag'] == etag and os.path.exists(file_path(name)):
+        return old, False
+    path = file_path(name)
+    partial = path + '.part'
+    f = open(partial, 'wb')
+    try:
+        # mtime=0 so the same xml always compresses to the same bytes
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0)
+        gz.write(xml)
+        gz.close()
+    finally:
+        f.close()
+    os.rename(partial, path)
+    return dict(etag=etag, updated=os.path.getmtime(path)), True
+
+def read_manifest():
+    try:
+        f = open(os.path.join(sitemap_root(), 'manifest.json'))
+    except IOError:
+        return {}
+    try:
+        return simplejson.load(f)
+    finally:
+        f.close()
+
+def write_manifest(manifest):
+    path = os.path.join(sitemap_root(), 'manifest.json')
+    f = open(path + '.part', 'w')
+    try:
+        simplejson.dump(manifest, f, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(path + '.part', path)
+
+def _changed_shards(since, last_day, today):
+    """Shards holding rows modified since the datetime given, or books published after last_day"""
+    dirty = set()
+    for kind, model, fields, filters, entry in KINDS:
+        for pk in model.objects.filter(modified__gte=since).values_list('pk', flat=True).iterator():
+            dirty.add(shard_name(kind, pk))
+    published = Book.objects.filter(publish_date__gt=last_day, publish_date__lte=today)
+    for pk in published.values_list('pk', flat=True):
+        dirty.add(shard_name('books', pk))
+    return dirty
+
+def update(rebuild=False):
+    """Rewrite shards whose urls may have changed, and the index; return (written, removed)"""
+    import fcntl
+
+    root = sitemap_root()
+    try:
+        os.makedirs(root)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    lock = open(os.path.join(root, 'manifest.lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        old = not rebuild and read_manifest() or {}
+        url = site_url()
+        if old.get('root') != url:
+            old = {}
+        started = datetime.now()
+        today = date.today()
+
+        counts = {'pages-0': 0}
+        for kind, model, fields, filters, entry in KINDS:
+            for pk in model.objects.filter(**filters).values_list('pk', flat=True).iterator():
+                name = shard_name(kind, pk)
+                counts[name] = counts.get(name, 0) + 1
+        old_shards = old.get('shards', {})
+        if old:
+            since = datetime.strptime(old['watermark'], "%Y-%m-%d %H:%M:%S") - SETTLE
+            last_day = datetime.strptime(old['day'], "%Y-%m-%d").date()
+            dirty = _changed_shards(since, last_day, today)
+        else:
+            dirty = set(counts)
+        # rows added or removed without a newer modified date, such as deleted ones, change the count
+        for name, count in counts.items():
+            if name not in old_shards or old_shards[name]['count'] != count:
+                dirty.add(name)
+
+        shards = {}
+        written = 0
+        for name in counts:
+            if name not in dirty:
+                shards[name] = old_shards[name]
+                continue
+            entries = shard_entries(name, today)
+            shards[name], changed = write_file(name, render_urlset(url, entries), old_shards.get(name))
+            shards[name]['count'] = counts[name]
+            lastmod = max([modified for u, modified, f, p in entries if modified] or [None])
+            shards[name]['lastmod'] = lastmod and lastmod.strftime("%Y-%m-%d")
+            written += changed
+        removed = set(old_shards).difference(shards)
+        for name in removed:
+            try:
+                os.remove(file_path(name))
+            except OSError:
+                pass
+
+        index, changed = write_file(None, render_index(url, shards), old.get('index'))
+        written += changed
+        write_manifest(dict(root=url, watermark=started.strftime("%Y-%m-%d %H:%M:%S"),
+            day=today.strftime("%Y-%m-%d"), index=index, shards=shards))
+        return written, len(removed)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+_manifest = [None, None]    # manifest, its file's mtime
+
+def manifest():
+    """The saved manifest, reread when build_sitemaps rewrites it; empty until it first runs"""
+    path = os.path.join(sitemap_root(), 'manifest.json')
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        # building here would hold up the request, and every other one behind the lock
+        return {}
+    if mtime != _manifest[1]:
+        _manifest[0] = read_manifest()
+        _manifest[1] = mtime
+    return _manifest[0]
+
+def file_entry(name):
+    """Manifest entry for the sitemap file name, a shard or None for the index; None if there's no such file"""
+    if name is None:
+        return manifest().get('index')
+    return manifest().get('shards', {}).get(name)
+
+def last_modified(name):
+    entry = file_entry(name)
+    return entry and datetime.utcfromtimestamp(entry['updated'])
+
+def etag(name):
+    entry = file_entry(name)
+    return entry and entry['etag']
+
+def serve(request, name):
+    """Response with the saved sitemap file name, compressed if the client accepts gzip"""
+    if not file_entry(name):
+        raise Http404
+    f = open(file_path(name), 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(data, content_type='application/xml')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.GzipFile(fileobj=StringIO(data)).read(), content_type='application/xml')
+    response['Content-Length'] = len(response.content)
+    response['Vary'] = 'Accept-Encoding'
+    return response
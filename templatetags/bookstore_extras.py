@@ -1,58 +1,39 @@
 from django.utils.http import urlquote
+from django.utils.html import escape
 from django import template
 from django.template import Context
 register = template.Library()
 
 from bookstore.models import Genre, Person, SitePage
+from bookstore.caching import cached_fragment, count
+from bookstore import images
 
 import datetime
 today = datetime.date.today
 now = datetime.datetime.now
 oneday = datetime.timedelta(1)
 
-import re
-_wiki_rules = [
-    (re.compile(r"\&"), "&amp;"),    # html characters
-    (re.compile(r"<"), "&lt;"),
-    (re.compile(r">"), "&gt;"),
-    (re.compile(r"\*([^*\s].*?[^*\s]|[^*\s])\*"), r"<strong>\1</strong>"),    # bold
-    (re.compile(r"_([^_\s].*?[^_\s]|[^_\s])_"), r"<em>\1</em>"),    # italic
-    (re.compile(r"\+([^+\s].*?[^+\s]|[^+\s])\+"), r"<u>\1</u>"),    # underline
-    (re.compile(r"^!\s+(.*)$"), r"<h2>\1</h2>"),      # h2
-    (re.compile(r"^!!\s+(.*)$"), r"<h3>\1</h3>"),     # h3
-    (re.compile(r"^!!!\s+(.*)$"), r"<h4>\1</h4>"),    # h4
-    (re.compile(r"^@center:!\s+(.*)$"), r"<h2 class='center'>\1</h2>"),   # h2
-    (re.compile(r"^@center:!!\s+(.*)$"), r"<h3 class='center'>\1</h3>"),  # h3
-    (re.compile(r"^@center:!!!\s+(.*)$"), r"<h4 class='center'>\1</h4>"), # h4
-    (re.compile(r"^={4,}$"), "</div><div class='entry ui-corner-all'>"), # bubble
-    (re.compile(r"^-{4,}$"), "<hr />"),      # hr
-    (re.compile(r"---"), "&mdash;"),
-    (re.compile(r"--"), "&ndash;"),
-    (re.compile(r"^@center:\s+(.*)$"), r"<p class='center'>\1</p>"),  # center
-    (re.compile(r"^@right:\s+(.*)$"), r"<p class='right'>\1</p>"),    # right
-    (re.compile(r"^$"), "<br /><br />"),     # hacky paragraph
-    (re.compile(r"\[a:(.*?)\]"), r"<a name='\1'></a>"), # named anchor
-    (re.compile(r"\[go(to)?:(.*?)\|(.*?)\]"), r"<a href='#\2'>\3</a>"), # internal link
-    (re.compile(r"\[url:(.*?)\|(.*?)\]"), r"<a href='\1'>\2</a>"),      # explicit link
-    (re.compile(r"\[color:(.*?)\|(.*?)\]"), r"<span style='color: \1;'>\2</span>"), # color override
-    (re.compile(r"\[youtube:(\d+)x(\d+)\|(\S+)\]"), r"""<object width="\1" height="\2"><param name="movie" value="http://www.youtube.com/v/$3&amp;hl=en_US&amp;fs=1&amp;color1=0x3a3a3a&amp;color2=0x999999&amp;border=1"><param name="allowFullScreen" value="true"><param name="allowscriptaccess" value="always"><embed type="application/x-shockwave-flash" width="\1" height="\2" src="http://www.youtube.com/v/\3&amp;hl=en_US&amp;fs=1&amp;color1=0x3a3a3a&amp;color2=0x999999&amp;border=1" allowscriptaccess="always" allowfullscreen="true" /></object>"""), # youtube link
-    (re.compile(r"""(^|[^:"'>]\b)(\w+:\/\/(?:[^\][ ()'",.]+(?:[\][(),.](?![\][()'",. ]|$)|[[(]?[\])]\.(?![()'",. ]|$))*)+)"""), r"\1<a href='\2'>\2</a>"),    # automatic link with schema
-    (re.compile(r"""(^|[^\/:"'>.\w])(www\.(?:[^\][ ()'",.]+(?:[\][(),.](?![\][()'",. ]|$)|[[(]?[\])]\.(?![()'",. ]|$))*)+)"""), r"\1<a href='http://\2'>\2</a>"),    # automatic link http assumed
-]
+from bookstore.markup import minifmt as _minifmt
+
+# Compiled templates for the tags below, loaded once per process.
+_templates = {}
+
+def get_template(name):
+    try:
+        return _templates[name]
+    except KeyError:
+        t = _templates[name] = template.loader.get_template(name)
+        return t
+
 @register.filter
-def minifmt(s, _wiki_rules=_wiki_rules):
-    lines = s.splitlines()
-    for i, line in enumerate(lines):
-        line_fmt = line
-        for rx, rp in _wiki_rules:
-            line_fmt, replaced = rx.subn(rp, line_fmt)
-        if line == line_fmt and len(lines) != 1:
-            line_fmt = "<p>" + line_fmt + "</p>"
-        lines[i] = line_fmt
-    fmt = "\n".join(lines)
-    return fmt
+def minifmt(s):
+    return _minifmt(s)
 minifmt.is_safe = True
 
+@register.filter
+def srcset(fieldfile):
+    return images.srcset(fieldfile)
+
 @register.filter
 def timespan(value):
     seconds = value.seconds
@@ -97,6 +78,8 @@ def ppattrs(value, name=None):
         
 @register.simple_tag
 def pager(info):
+    if getattr(info, 'cursor', False):
+        return cursor_pager(info)
     if info.pagecount < 2:
         return ''
     pieces = [
@@ -111,6 +94,17 @@ def pager(info):
         for i in range(info.pagecount) ]
     return ''.join(pieces).encode('ascii', 'xmlcharrefreplace')
 
+def cursor_pager(info):
+    if not (info.prev or info.next):
+        return ''
+    pieces = [
+        '<div id="pager"><span class="pager ui-corner-all">',
+        info.prev and ('<a href="%s" title="Previous Page">&laquo;</a>' % escape(info.prev)) or '&laquo;',
+        info.next and ('<a href="%s" title="Next Page">&raquo;</a>' % escape(info.next)) or '&raquo;',
+        '</span></div>',
+        ]
+    return ''.join(pieces).encode('ascii', 'xmlcharrefreplace')
+
 def set_of(items, template, empty='', first=', ', final=' &amp; '):
     pieces = map(template, items)
     if not pieces: return empty
@@ -124,7 +118,7 @@ def authorsof(book, linkify=True):
         template = lambda a: '<a href="%s">%s %s</a>' % (a.get_absolute_url(), a.firstname, a.lastname)
     else:
         template = lambda a: '%s %s' % (a.firstname, a.lastname)
-    return set_of(book.authors.all(), template, '(nobody)')
+    return set_of(book.author_list(), template, '(nobody)')
         
 @register.simple_tag
 def genresof(book, linkify=True):
@@ -132,7 +126,7 @@ def genresof(book, linkify=True):
         template = lambda g: '<a href="%s">%s</a>' % (g.get_absolute_url(), g.name)
     else:
         template = lambda g: '%s' % (g.name)
-    return set_of(book.genres.all(), template, '(none)')
+    return set_of(book.genre_list(), template, '(none)')
     
 @register.simple_tag
 def fblike(link):
@@ -144,28 +138,36 @@ def fbrec(link, refkind, ref):
 
 @register.simple_tag
 def genre_sidebar():
-    t = template.loader.get_template('bookstore/genre_sidebar.html')
-    return t.render(Context({'genres': Genre.objects.filter(visible=True).order_by("display_order")}))
+    def render():
+        t = get_template('bookstore/genre_sidebar.html')
+        return t.render(Context({'genres': Genre.objects.filter(visible=True).order_by("display_order")}))
+    return cached_fragment('genre_sidebar', render, ('genre',))
 
 @register.simple_tag
 def author_sidebar():
-    t = template.loader.get_template('bookstore/author_sidebar.html')
-    return t.render(Context({'authors': Person.objects.filter(author=True, visible=True).order_by('-rank')[:6]}))
+    def render():
+        t = get_template('bookstore/author_sidebar.html')
+        return t.render(Context({'authors': Person.objects.filter(author=True, visible=True).order_by('-rank')[:6]}))
+    return cached_fragment('author_sidebar', render, ('person',))
 
 @register.simple_tag
 def staff_sidebar():
-    t = template.loader.get_template('bookstore/staff_sidebar.html')
+    t = get_template('bookstore/staff_sidebar.html')
     return t.render(Context())
 
 @register.simple_tag
 def site_headnav():
-    t = template.loader.get_template('bookstore/site_headnav.html')
-    return t.render(Context({'pages': SitePage.objects.filter(visible=True, showinheader=True).order_by('display_order')}))
+    def render():
+        t = get_template('bookstore/site_headnav.html')
+        return t.render(Context({'pages': SitePage.objects.filter(visible=True, showinheader=True).order_by('display_order')}))
+    return cached_fragment('site_headnav', render, ('sitepage',))
     
 @register.simple_tag
 def site_footnav():
-    t = template.loader.get_template('bookstore/site_footnav.html')
-    return t.render(Context({'pages': SitePage.objects.filter(visible=True, showinfooter=True).order_by('display_order')}))
+    def render():
+        t = get_template('bookstore/site_footnav.html')
+        return t.render(Context({'pages': SitePage.objects.filter(visible=True, showinfooter=True).order_by('display_order')}))
+    return cached_fragment('site_footnav', render, ('sitepage',))
 
 @register.tag
 def bookcard(parser, token):
@@ -176,13 +178,33 @@ def bookcard(parser, token):
         raise template.TemplateSyntaxError, "%r tag requires exactly one arguments" % token.contents.split()[0]
     return FormatBookCardNode(book_variable)
     
+# Rendered cards for this process, by everything a card shows that can change:
+# the book's modified date, which saving the book, its prices, authors or
+# genres updates; its price; whether it's published yet; its small cover,
+# which build_images fills in, and the image manifest for its srcset.
+_cards = {}
+CARD_MEMO_SIZE = 2000
+
+def card_key(book, autoescape):
+    return (book.pk, book.modified, book.price, book.is_published, book.small_image.name,
+        images.manifest_version(), autoescape)
+
 class FormatBookCardNode(template.Node):
     def __init__(self, book_variable):
         self.book_reference = template.Variable(book_variable)
     def render(self, context):
         book = self.book_reference.resolve(context)
-        t = template.loader.get_template('bookstore/book_summary.html')
-        return t.render(Context({'book': book}, autoescape=context.autoescape))
+        key = card_key(book, context.autoescape)
+        html = _cards.get(key)
+        if html is None:
+            count('bookcard', 'miss')
+            html = get_template('bookstore/book_summary.html').render(Context({'book': book}, autoescape=context.autoescape))
+            if len(_cards) >= CARD_MEMO_SIZE:
+                _cards.clear()
+            _cards[key] = html
+        else:
+            count('bookcard', 'hit')
+        return html
         
 @register.tag
 def sort(parser, token):
@@ -201,6 +223,9 @@ class FormatSortLinkNode(template.Node):
         sort = self.sort_reference.resolve(context)
         
         req = request.GET.copy()
+        # a cursor only makes sense in the order it came from
+        for name in ("after", "before"):
+            req.pop(name, None)
         current_sort = req.get("sort")
         direction = "+-"[current_sort == ("+" + sort)]
         req["sort"] = direction + sort
@@ -223,7 +248,7 @@ class PreviewTemplateNode(template.Node):
         self.template_reference = template.Variable(template_variable)
     def render(self, context):
         template_name = self.template_reference.resolve(context)
-        t = template.loader.get_template(template_name)
+        t = get_template(template_name)
         pm = PreviewMapper()
         return t.render(Context(dict(purchase=pm, book=pm), autoescape=context.autoescape)).replace("\n", "<br/>")
 
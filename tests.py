@@ -21,3 +21,588 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+from bookstore import markup
+import random
+
+class MinifmtTest(TestCase):
+    golden = [
+        u"",
+        u"A single line with *bold*, _italic_ and +underline+.",
+        u"First paragraph.\n\nSecond -- with a dash --- and an em dash.",
+        u"! Heading\n!! Subheading\n!!! Minor heading\n!not a heading",
+        u"@center:! Centered\n@center:!! Centered\n@center:!!! Centered\n@center: text\n@right: text",
+        u"above\n====\nbelow\n----\n---\n-----",
+        u"[a:top] [goto:top|Back to top] [go:top|up] [url:http://example.com/x|Example]",
+        u"[color:red|warning] [youtube:480x385|abcdEFG]",
+        u"See http://www.example.com/a(b)/c. or www.example.org, or <a href='http://x.y'>x</a>",
+        u"Tom & Jerry <3 *a_b*c_ +x*y+z* __ ** ++",
+        u"caf\xe9 \u2014 na\xefve\r\nwindows\x0cform feed\u2028line sep",
+    ]
+
+    def test_golden(self):
+        for text in self.golden:
+            self.assertEqual(markup.minifmt(text), markup.minifmt_rules(text))
+
+    def test_random(self):
+        pieces = [u"*", u"_", u"+", u"! ", u"!! ", u"@center:", u"@right: ", u"====", u"----", u"--", u"-",
+            u"[a:x]", u"[goto:y|z]", u"[url:http://a.b/c|d]", u"[color:red|e]", u"[youtube:1x2|v]",
+            u"http://www.x.com/a(b).", u"www.y.org", u"&", u"<", u">", u"'", u":", u".", u"[", u"]", u"|",
+            u" ", u"word", u"\n", u"\n\n", u"="]
+        rnd = random.Random(0)
+        for trial in range(5000):
+            text = u"".join(rnd.choice(pieces) for i in range(rnd.randint(0, 12)))
+            self.assertEqual(markup.minifmt(text), markup.minifmt_rules(text), repr(text))
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from bookstore.models import Book, BookFormat, BookPublication, Purchase, PurchaseEmail
+from bookstore import outbox
+from datetime import date, datetime
+
+def make_publication():
+    book = Book.objects.create(link='test-book', title='Test Book', size='Novel', blurb='Blurb',
+        description='Description', page_image='cover.jpg', page_image_small='cover_small.jpg',
+        added_date=date.today(), publish_date=date.today(), ero_rating='Smoke', visible=True)
+    format = BookFormat.objects.create(name='PDF', blurb='Portable Document Format', extension='pdf',
+        mime='application/pdf', display_order=1, image='pdf.png', width=16, height=16)
+    return BookPublication.objects.create(book=book, format=format, data='test.pdf', data_hash='0' * 40)
+
+def make_purchase(publication, **kwargs):
+    customer = User.objects.create_user('buyer', 'buyer@example.com', 'secret')
+    fields = dict(price='1.99', publication=publication, customer=customer, email=customer.email,
+        address='127.0.0.1', email_name='Buyer', email_address=customer.email)
+    fields.update(kwargs)
+    return Purchase.objects.create(**fields)
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, messages):
+        raise IOError("mail server unavailable")
+
+class OutboxTest(TestCase):
+    def test_ready_purchase_is_queued_not_sent(self):
+        purchase = make_purchase(make_publication(), status='R')
+        self.assertEqual(PurchaseEmail.objects.filter(purchase=purchase).count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_pending_purchase_is_not_queued(self):
+        make_purchase(make_publication(), status='P')
+        self.assertEqual(PurchaseEmail.objects.count(), 0)
+
+    def test_send_queued(self):
+        purchase = make_purchase(make_publication(), status='R')
+        self.assertEqual(outbox.send_queued(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['"Buyer" <buyer@example.com>'])
+        purchase = Purchase.objects.get(pk=purchase.pk)
+        self.assertTrue(purchase.email_sent)
+        self.assertTrue(purchase.email_sent_date)
+        self.assertEqual(outbox.send_queued(), (0, 0))
+
+    def test_failed_send_is_retried_later(self):
+        purchase = make_purchase(make_publication(), status='R')
+        self.assertEqual(outbox.send_queued(connection=FailingEmailBackend()), (0, 1))
+        email = PurchaseEmail.objects.get(purchase=purchase)
+        self.assertEqual(email.attempts, 1)
+        self.assertTrue(email.next_attempt > datetime.now())
+        self.assertFalse(Purchase.objects.get(pk=purchase.pk).email_sent)
+        # not due yet
+        self.assertEqual(outbox.send_queued(), (0, 0))
+
+from bookstore.models import PaypalIpn
+from bookstore import paypal
+
+class StubVerifier(object):
+    def __init__(self, verdict):
+        self.verdict = verdict
+
+    def verify(self, params):
+        if isinstance(self.verdict, Exception):
+            raise self.verdict
+        return self.verdict
+
+class PaypalIpnTest(TestCase):
+    def queue_ipn(self, purchase, txn_id='TXN1', payment='1.99'):
+        params = 'invoice=rlbp_%s&txn_id=%s&txn_type=web_accept&payment_status=Completed' % (purchase.pk, txn_id)
+        return PaypalIpn.objects.create(purchase=purchase, params=params, payment=payment, currency='USD',
+            payment_status='Completed', txn_id=txn_id, download_link='http://example.com/download/', state='Q')
+
+    def test_verified_payment_readies_purchase(self):
+        purchase = make_purchase(make_publication(), status='P')
+        ipn = self.queue_ipn(purchase)
+        self.assertEqual(paypal.process_queued(pool=StubVerifier('VERIFIED'), threads=2), 1)
+        self.assertEqual(PaypalIpn.objects.get(pk=ipn.pk).state, 'A')
+        purchase = Purchase.objects.get(pk=purchase.pk)
+        self.assertEqual(purchase.status, 'R')
+        self.assertEqual(purchase.email_link, 'http://example.com/download/')
+
+    def test_resent_notification_is_duplicate(self):
+        purchase = make_purchase(make_publication(), status='P')
+        first, second = self.queue_ipn(purchase), self.queue_ipn(purchase)
+        paypal.process_queued(pool=StubVerifier('VERIFIED'))
+        self.assertEqual(PaypalIpn.objects.get(pk=first.pk).state, 'A')
+        self.assertEqual(PaypalIpn.objects.get(pk=second.pk).state, 'D')
+
+    def test_invalid_and_short_payments_are_not_applied(self):
+        purchase = make_purchase(make_publication(), status='P')
+        invalid = self.queue_ipn(purchase)
+        paypal.process_queued(pool=StubVerifier('INVALID'))
+        short = self.queue_ipn(purchase, txn_id='TXN2', payment='0.99')
+        paypal.process_queued(pool=StubVerifier('VERIFIED'))
+        self.assertEqual(PaypalIpn.objects.get(pk=invalid.pk).state, 'I')
+        self.assertEqual(PaypalIpn.objects.get(pk=short.pk).state, 'B')
+        self.assertEqual(Purchase.objects.get(pk=purchase.pk).status, 'P')
+
+    def test_unexpected_answer_leaves_queued(self):
+        purchase = make_purchase(make_publication(), status='P')
+        ipn = self.queue_ipn(purchase)
+        self.assertEqual(paypal.process_queued(pool=StubVerifier('<html>Down for maintenance</html>')), 0)
+        self.assertEqual(PaypalIpn.objects.get(pk=ipn.pk).state, 'Q')
+
+    def test_unreachable_verifier_leaves_queued(self):
+        purchase = make_purchase(make_publication(), status='P')
+        ipn = self.queue_ipn(purchase)
+        self.assertEqual(paypal.process_queued(pool=StubVerifier(IOError("timed out"))), 0)
+        self.assertEqual(PaypalIpn.objects.get(pk=ipn.pk).state, 'Q')
+
+from bookstore.models import BookPrice, begin_book_touches, end_book_touches, books_touched
+from bookstore import caching
+
+class BookTouchTest(TestCase):
+    def setUp(self):
+        self.touched = []
+        books_touched.connect(self.record, dispatch_uid="record@BookTouchTest")
+
+    def tearDown(self):
+        books_touched.disconnect(dispatch_uid="record@BookTouchTest")
+
+    def record(self, sender, **kwargs):
+        self.touched.append(kwargs['book_ids'])
+
+    def test_batch_updates_each_book_once(self):
+        book = make_publication().book
+        self.touched = []
+        avoided = caching.stats.get('book_modified', {}).get('avoided', 0)
+        begin_book_touches()
+        BookPrice.objects.create(book=book, price='1.99', currency='USD')
+        BookPrice.objects.create(book=book, price='1.49', currency='EUR')
+        self.assertEqual(self.touched, [])
+        end_book_touches()
+        self.assertEqual(self.touched, [[book.pk]])
+        self.assertEqual(caching.stats['book_modified']['avoided'], avoided + 1)
+
+    def test_touch_without_batch_updates_at_once(self):
+        book = make_publication().book
+        self.assertEqual(self.touched, [[book.pk]])
+
+from django.http import HttpRequest, QueryDict
+from bookstore.views import CursorPager, STAFF_PURCHASE_COLUMNS
+
+class CursorPagerTest(TestCase):
+    def page(self, query):
+        request = HttpRequest()
+        request.GET = request.REQUEST = QueryDict(query)
+        return CursorPager(request, Purchase.objects.all(), STAFF_PURCHASE_COLUMNS, "-date", pagesize=2)
+
+    def test_walk_forward_and_back(self):
+        first = make_purchase(make_publication())
+        for i in range(4):
+            Purchase.objects.create(price='1.99', publication=first.publication, customer=first.customer,
+                email=first.email, address='127.0.0.1')
+        expected = list(Purchase.objects.order_by('price', 'pk').values_list('pk', flat=True))
+
+        pages, pager = [], self.page("sort=%2Bprice")
+        self.assertEqual(pager.prev, "")
+        while True:
+            pages.append([p.pk for p in pager.items])
+            if not pager.next:
+                break
+            pager = self.page(pager.next[1:])
+        self.assertEqual(pages, [expected[0:2], expected[2:4], expected[4:5]])
+
+        pager = self.page(pager.prev[1:])
+        self.assertEqual([p.pk for p in pager.items], expected[2:4])
+        pager = self.page(pager.prev[1:])
+        self.assertEqual([p.pk for p in pager.items], expected[0:2])
+        self.assertEqual(pager.prev, "")
+
+    def test_page_size_is_clamped(self):
+        self.assertEqual(self.page("c=-5").size, 1)
+        self.assertEqual(self.page("c=100000").size, 8)
+
+    def test_damaged_cursor_shows_first_page(self):
+        make_purchase(make_publication())
+        self.assertEqual(len(self.page("after=oops").items), 1)
+
+from bookstore.models import Download, SalesRollup, DownloadRollup
+from bookstore import reports
+from datetime import timedelta
+
+class RollupTest(TestCase):
+    def test_rollups_count_each_row_once(self):
+        purchase = make_purchase(make_publication(), status='R')
+        self.assertTrue(purchase.ready_date)
+        purchase.record_download('127.0.0.1')
+        an_hour_ago = datetime.now() - timedelta(hours=1)
+        Purchase.objects.filter(pk=purchase.pk).update(ready_date=an_hour_ago)
+        Download.objects.filter(purchase=purchase).update(timestamp=an_hour_ago)
+
+        self.assertEqual(reports.update_rollups(), (1, 1))
+        self.assertEqual(reports.update_rollups(), (0, 0))
+        sales = SalesRollup.objects.get()
+        self.assertEqual((sales.day, sales.sales, str(sales.revenue)), (an_hour_ago.date(), 1, '1.990'))
+        self.assertEqual(DownloadRollup.objects.get().downloads, 1)
+
+        report = reports.sales_report()
+        self.assertEqual(report['by_book'][0]['sales'], 1)
+        self.assertEqual(report['by_book'][0]['downloads'], 1)
+
+    def test_review_copies_are_not_revenue(self):
+        purchase = make_purchase(make_publication(), status='R', transaction='V')
+        Purchase.objects.filter(pk=purchase.pk).update(ready_date=datetime.now() - timedelta(hours=1))
+        self.assertEqual(reports.update_rollups(), (1, 0))
+        report = reports.sales_report()
+        self.assertEqual(report['by_book'], [])
+        self.assertEqual(report['by_day'], [])
+        self.assertEqual(report['by_kind'][0]['sales'], 1)
+
+    def test_recent_rows_wait_to_settle(self):
+        make_purchase(make_publication(), status='R')
+        self.assertEqual(reports.update_rollups(), (0, 0))
+
+from bookstore.models import MergedUser, get_merged_account_ids
+
+class MergedAccountTest(TestCase):
+    def test_merging_updates_cached_ids(self):
+        one = User.objects.create_user('one', 'one@example.com', 'secret')
+        two = User.objects.create_user('two', 'two@example.com', 'secret')
+        self.assertEqual(get_merged_account_ids(one.pk), [one.pk])
+        merged = MergedUser.objects.create(name='One')
+        merged.accounts.add(one)
+        self.assertEqual(get_merged_account_ids(one.pk), [one.pk])
+        merged.accounts.add(two)
+        self.assertEqual(get_merged_account_ids(one.pk), sorted([one.pk, two.pk]))
+        self.assertEqual(get_merged_account_ids(two.pk), sorted([one.pk, two.pk]))
+        merged.accounts.remove(two)
+        self.assertEqual(get_merged_account_ids(one.pk), [one.pk])
+        merged.delete()
+        self.assertEqual(get_merged_account_ids(two.pk), [two.pk])
+
+from bookstore.search import SearchIndex
+
+class SearchIndexTest(TestCase):
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.add(1, dict(title=u"Dragon Queen", authors=u"Ann Smith", blurb=u"A queen and her dragon."))
+        self.index.add(2, dict(title=u"Winter Station", authors=u"Ben Dragomir", description=u"The queen's station."))
+        self.index.add(3, dict(title=u"Caf\xe9 Noir", genres=u"Horror", blurb=u"See [url:http://example.com/dragon|the site]."))
+
+    def ids(self, query):
+        return [doc for score, doc in self.index.search(query)]
+
+    def test_ranking_and_prefixes(self):
+        self.assertEqual(self.ids(u"drago"), [1, 2])
+        self.assertEqual(self.ids(u"drag"), [1, 2])
+        self.assertEqual(self.ids(u"dragon "), [1])
+        self.assertEqual(self.ids(u"dragon"), [1])
+        self.assertEqual(self.ids(u"queen"), [1, 2])
+        self.assertEqual(self.ids(u"queen st"), [2])
+        self.assertEqual(self.ids(u"cafe"), [3])
+        self.assertEqual(self.ids(u"the"), [])
+
+    def test_update_and_reload(self):
+        self.index.add(1, dict(title=u"Storm Crown"))
+        self.assertEqual(self.ids(u"dragon"), [])
+        self.index.remove(2)
+        self.assertEqual(self.ids(u"queen"), [])
+        loaded = SearchIndex.loads(self.index.dumps())
+        self.assertEqual([doc for score, doc in loaded.search(u"storm")], [1])
+        loaded.add(4, dict(title=u"Storm Front"))
+        self.assertEqual(sorted(doc for score, doc in loaded.search(u"storm")), [1, 4])
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from bookstore import sitemaps
+import gzip
+import shutil
+import tempfile
+
+class SitemapTest(TestCase):
+    def setUp(self):
+        self.saved = [getattr(settings, name, None) for name in ('BOOKSTORE_SITEMAP_ROOT', 'BOOKSTORE_SITE_URL')]
+        settings.BOOKSTORE_SITEMAP_ROOT = tempfile.mkdtemp()
+        settings.BOOKSTORE_SITE_URL = 'http://example.com/'
+
+    def tearDown(self):
+        shutil.rmtree(settings.BOOKSTORE_SITEMAP_ROOT)
+        settings.BOOKSTORE_SITEMAP_ROOT, settings.BOOKSTORE_SITE_URL = self.saved
+
+    def read(self, name):
+        return gzip.open(sitemaps.file_path(name)).read()
+
+    def test_only_changed_shards_are_written(self):
+        book = make_publication().book
+        # the index, pages-0, and books-0
+        self.assertEqual(sitemaps.update(), (3, 0))
+        self.assertTrue('<loc>http://example.com%s</loc>' % book.get_absolute_url() in self.read('books-0'))
+        self.assertTrue('sitemap-books-0.xml' in self.read(None))
+        self.assertEqual(sitemaps.update(), (0, 0))
+
+        book.visible = False
+        book.save()
+        self.assertEqual(sitemaps.update(), (1, 1))
+        self.assertFalse('sitemap-books-0.xml' in self.read(None))
+
+    def test_view_revalidates(self):
+        make_publication()
+        url = reverse('bookstore.views.sitemap', kwargs=dict(shard='books-0'))
+        # not built within a request
+        self.assertEqual(self.client.get(url).status_code, 404)
+        sitemaps.update()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('<urlset' in response.content)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+from django.contrib.auth.models import AnonymousUser
+from bookstore.conditional import page_etag, page_last_modified
+
+class ConditionalTest(TestCase):
+    def validators(self, book):
+        request = HttpRequest()
+        request.user = AnonymousUser()
+        querysets = [Book.objects.filter(pk=book.pk)]
+        return page_etag(request, querysets), page_last_modified(request, querysets)
+
+    def test_changes_to_book_parts_change_validators(self):
+        book = make_publication().book
+        first = self.validators(book)
+        self.assertEqual(self.validators(book), first)
+        price = BookPrice.objects.create(book=book, price='1.99', currency='USD')
+        second = self.validators(book)
+        self.assertNotEqual(second[0], first[0])
+        price.delete()
+        self.assertNotEqual(self.validators(book)[0], second[0])
+
+    def test_signed_in_pages_have_no_last_modified(self):
+        book = make_publication().book
+        request = HttpRequest()
+        request.user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.assertEqual(page_last_modified(request, [Book.objects.filter(pk=book.pk)]), None)
+
+from django.http import HttpResponse
+from bookstore.caching import depend_on, model_tag
+from bookstore.pagecache import cache_anonymous_page
+
+class PageCacheTest(TestCase):
+    def setUp(self):
+        self.book = make_publication().book
+        self.renders = 0
+        self.view = cache_anonymous_page(self.render)
+
+    def render(self, request):
+        self.renders += 1
+        depend_on(model_tag(Book, self.book.pk))
+        return HttpResponse("page %d" % self.renders)
+
+    def get(self, user=None):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.path = '/test/page-cache/%d' % self.book.pk
+        request.META = dict(SERVER_NAME='testserver', SERVER_PORT='80')
+        request.user = user or AnonymousUser()
+        return self.view(request).content
+
+    def test_pages_are_cached_until_their_books_change(self):
+        self.assertEqual(self.get(), "page 1")
+        self.assertEqual(self.get(), "page 1")
+        BookPrice.objects.create(book=self.book, price='1.99', currency='USD')
+        self.assertEqual(self.get(), "page 2")
+        self.book.save()
+        self.assertEqual(self.get(), "page 3")
+        self.assertEqual(self.get(), "page 3")
+
+    def test_signed_in_pages_are_not_cached(self):
+        user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.assertEqual(self.get(user), "page 1")
+        self.assertEqual(self.get(user), "page 2")
+
+from bookstore.models import SlugRoute
+from bookstore import routing
+
+class RoutingTest(TestCase):
+    def test_renamed_links_route_to_the_new_link(self):
+        book = make_publication().book
+        self.assertEqual(routing.resolve('book', 'Test-Book'), (book.pk, 'test-book'))
+        book.link = 'renamed-book'
+        book.save()
+        self.assertEqual(routing.resolve('book', 'test-book'), (book.pk, 'renamed-book'))
+        self.assertEqual(routing.resolve('book', 'renamed-book'), (book.pk, 'renamed-book'))
+        self.assertEqual(routing.resolve('book', 'no-such-book'), None)
+        book.delete()
+        self.assertEqual(routing.resolve('book', 'renamed-book'), None)
+
+    def test_links_without_routes_are_healed(self):
+        book = make_publication().book
+        SlugRoute.objects.all().delete()
+        routing.forget_routes()
+        self.assertEqual(routing.resolve('book', 'TEST-book'), (book.pk, 'test-book'))
+        self.assertEqual(SlugRoute.objects.get().slug, 'test-book')
+
+from bookstore import picks
+
+class PicksTest(TestCase):
+    def test_pool_choice_is_weighted_and_excludes(self):
+        pool = picks.Pool({1: 1, 2: 3, 3: 0})
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.choose(random=lambda: 0.0), 1)
+        self.assertEqual(pool.choose(random=lambda: 0.3), 2)
+        self.assertEqual(pool.choose(exclude=2, random=lambda: 0.9), 1)
+        self.assertEqual(pool.choose(exclude=1, random=lambda: 0.0), 2)
+        self.assertEqual(picks.Pool({1: 1}).choose(exclude=1), None)
+
+    def test_pools_follow_book_changes(self):
+        book = make_publication().book
+        self.assertEqual(picks.site_picks(), (None, None))
+        book.bestseller = True
+        book.feature = True
+        book.save()
+        # one book can't fill both slots
+        self.assertEqual(picks.site_picks(), (book, None))
+        book.visible = False
+        book.save()
+        self.assertEqual(picks.site_picks(), (None, None))
+
+from bookstore.models import Person
+from bookstore import ranking
+
+class RankingTest(TestCase):
+    def test_activity_is_ranked_once_and_decays(self):
+        purchase = make_purchase(make_publication(), status='R')
+        author = Person.objects.create(firstname='Ann', lastname='Smith', email='ann@example.com',
+            link='ann-smith', author=True, visible=True)
+        purchase.publication.book.authors.add(author)
+        purchase.record_download('127.0.0.1')
+        an_hour_ago = datetime.now() - timedelta(hours=1)
+        Purchase.objects.filter(pk=purchase.pk).update(ready_date=an_hour_ago)
+        Download.objects.filter(purchase=purchase).update(timestamp=an_hour_ago)
+
+        self.assertEqual(ranking.update_ranks(), (1, 1))
+        rank = Person.objects.get(pk=author.pk).rank
+        self.assertTrue(10.9 < rank < 11.0)
+        self.assertEqual(ranking.update_ranks(), (0, 0))
+        self.assertTrue(Person.objects.get(pk=author.pk).rank < rank)
+
+        ranking.reset_ranks()
+        self.assertEqual(ranking.update_ranks(), (1, 1))
+        self.assertTrue(10.9 < Person.objects.get(pk=author.pk).rank < 11.0)
+
+from django.core.cache import cache
+from bookstore.models import Genre, BookSales
+from bookstore import bestsellers
+
+class BestsellerTest(TestCase):
+    def setUp(self):
+        self.purchase = make_purchase(make_publication(), status='R')
+        self.book = self.purchase.publication.book
+        self.genre = Genre.objects.create(link='fantasy', name='Fantasy', blurb='Blurb', visible=True,
+            description='Description', text_color='white', page_color='black', page_image='genre.jpg')
+        self.book.genres.add(self.genre)
+
+    def tearDown(self):
+        for window in bestsellers.WINDOWS:
+            for genre in (None, self.genre.pk):
+                cache.delete(bestsellers.BESTSELLER_CACHE_KEY % (window, genre))
+
+    def test_ready_purchases_are_counted_and_ranked(self):
+        sales = BookSales.objects.get(book=self.book)
+        self.assertEqual((sales.sales_7, sales.sales_30, sales.sales_90), (1, 1, 1))
+        # the first run counts the windows again from the purchases
+        self.assertEqual(bestsellers.update_bestsellers(), 6)
+        self.assertEqual(bestsellers.top_books(7), [(self.book.pk, 1)])
+        self.assertEqual(bestsellers.top_books(30, self.genre.pk), [(self.book.pk, 1)])
+        self.assertEqual(bestsellers.update_bestsellers(), 0)
+
+    def test_review_copies_are_not_sales(self):
+        customer = self.purchase.customer
+        Purchase.objects.create(price='1.99', publication=self.purchase.publication, customer=customer,
+            email=customer.email, address='127.0.0.1', status='R', transaction='V')
+        self.assertEqual(BookSales.objects.get(book=self.book).sales_30, 1)
+        bestsellers.update_bestsellers()
+        self.assertEqual(bestsellers.top_books(30), [(self.book.pk, 1)])
+
+    def test_sales_slide_out_of_windows(self):
+        ten_days_ago = date.today() - timedelta(days=10)
+        Purchase.objects.filter(pk=self.purchase.pk).update(ready_date=ten_days_ago)
+        reports.set_watermark('bestsellers.day', ten_days_ago.isoformat())
+        # only the 30 and 90 day lists, overall and for the genre, were stored
+        self.assertEqual(bestsellers.update_bestsellers(), 4)
+        sales = BookSales.objects.get(book=self.book)
+        self.assertEqual((sales.sales_7, sales.sales_30, sales.sales_90), (0, 1, 1))
+        self.assertEqual(bestsellers.top_books(7), [])
+        self.assertEqual(bestsellers.top_books(30), [(self.book.pk, 1)])
+
+from django.template import Context, Template
+
+class BookCardTest(TestCase):
+    def render(self, book):
+        return Template("{% load bookstore_extras %}{% bookcard book %}").render(Context({'book': book}))
+
+    def test_cards_are_rendered_once_until_they_change(self):
+        book = make_publication().book
+        price = BookPrice.objects.create(book=book, price='1.99', currency='USD')
+        book = Book.objects.get(pk=book.pk)
+        misses = caching.stats.get('bookcard', {}).get('miss', 0)
+        html = self.render(book)
+        self.assertTrue('$1.99' in html)
+        self.assertEqual(self.render(Book.objects.get(pk=book.pk)), html)
+        self.assertEqual(caching.stats['bookcard']['miss'], misses + 1)
+
+        price.price = '2.99'
+        price.save()
+        self.assertTrue('$2.99' in self.render(Book.objects.get(pk=book.pk)))
+        self.assertEqual(caching.stats['bookcard']['miss'], misses + 2)
+
+class DownloadSummaryTest(TestCase):
+    def test_stale_copies_keep_every_download(self):
+        purchase = make_purchase(make_publication(), status='R')
+        stale = Purchase.objects.get(pk=purchase.pk)
+        purchase.record_download('127.0.0.1')
+        stale.record_download('127.0.0.1')
+        purchase = Purchase.objects.get(pk=purchase.pk)
+        self.assertEqual(purchase.download_count, 2)
+        self.assertEqual(len(purchase.recent_download_times()), 2)
+
+from bookstore import delivery
+
+class DeliveryTest(TestCase):
+    def test_served_from_what_was_sent(self):
+        request = HttpRequest()
+        request.META = dict(HTTP_RANGE='bytes=100-')
+        partial = HttpResponse('', status=206)
+        partial['Content-Range'] = 'bytes 100-199/200'
+        self.assertEqual(delivery.served_from(request, partial, 200, 'a' * 40), 100)
+        # a failed If-Range sends the whole file
+        self.assertEqual(delivery.served_from(request, HttpResponse(''), 200, 'a' * 40), 0)
+        sent = HttpResponse('')
+        sent['X-Sendfile'] = '/media/test.pdf'
+        self.assertEqual(delivery.served_from(request, sent, 200, 'a' * 40), 100)
+        request.META['HTTP_IF_RANGE'] = '"%s"' % ('b' * 40)
+        self.assertEqual(delivery.served_from(request, sent, 200, 'a' * 40), 0)
+
+    def test_only_recorded_downloads_can_be_resumed(self):
+        purchase = make_purchase(make_publication(), status='R')
+        self.assertFalse(purchase.resume_download('0' * 40, 1))
+        purchase.record_download('127.0.0.1', '0' * 40)
+        self.assertFalse(purchase.resume_download('1' * 40, 1))
+        self.assertTrue(purchase.resume_download('0' * 40, 1))
+
+    def test_a_download_is_resumed_once_from_each_offset(self):
+        purchase = make_purchase(make_publication(), status='R')
+        purchase.record_download('127.0.0.1', '0' * 40)
+        # bytes=1- twice: the second is a new download
+        self.assertTrue(purchase.resume_download('0' * 40, 1))
+        self.assertFalse(purchase.resume_download('0' * 40, 1))
+        self.assertTrue(purchase.resume_download('0' * 40, 100))
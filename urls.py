@@ -9,9 +9,11 @@ urlpatterns = patterns('bookstore.views',
     (r'^author/$', 'author_list'),
     (r'^author/(?P<author_link>[\w-]+)$', 'author_detail'),
     (r'^book/$', 'book_list'),
+    (r'^bestsellers/$', 'bestsellers'),
     (r'^book/(?P<book_link>[\w-]+)$', 'book_detail'),
     (r'^book/(?P<migrate_url>[^/]+)/(?P<book_link>[\w-]+)$', 'book_detail'), # migrate old urls
     (r'^coming-soon/$', 'coming_soon'),
+    (r'^search/$', 'search'),
     url(r'^signin/$', 'openid_login', name='openid-login'),
     url(r'^signin/complete/$', 'openid_complete', name='openid-complete'),
     (r'^signin/$', 'signin'),
@@ -30,7 +32,10 @@ urlpatterns = patterns('bookstore.views',
     (r'^staff/purchase/$', 'staff_purchase'),
     (r'^staff/purchase/(?P<purchase_id>[^/]+)/$', 'staff_purchase_detail'),
     (r'^staff/review/$', 'staff_review'),
+    (r'^staff/sales/$', 'staff_sales'),
+    (r'^staff/cache/$', 'staff_cache'),
     (r'^sitemap.xml$', 'sitemap'),
+    (r'^sitemap-(?P<shard>[a-z]+-\d+).xml$', 'sitemap'),
     (r'^(?P<migrate_url>page/)(?P<page_link>[\w-]+)$', 'site_page'),
     (r'^(?P<page_link>[\w-]+)$', 'site_page'),
 )
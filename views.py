@@ -1,7 +1,8 @@
 # bookstore views
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, Http404
 from django.core.urlresolvers import reverse
 from django.utils.html import escape, linebreaks
+from django.utils.http import urlencode
 from django.shortcuts import render_to_response, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, logout
@@ -9,37 +10,49 @@ from django.contrib import messages
 from django.template import RequestContext
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import condition, require_POST
-from django.db.models import Count
+from django.db.models import Q
+from django.core.exceptions import ValidationError
 
 from bookstore.models import Genre, Person, Book, BookPublication, BookFormat
-from bookstore.models import Purchase, MergedUser, PaypalIpn, Download
+from bookstore.models import Purchase, PaypalIpn, Watermark, get_merged_account_ids
 from bookstore.models import SiteNewsBanner, SitePage, StorefrontNewsCard, StorefrontAd
+from bookstore.catalog import load_cards
+from bookstore.conditional import catalog_condition
+from bookstore.pagecache import cache_anonymous_page
+from bookstore import caching, delivery, picks, reports, routing, sitemaps
+from bookstore.caching import depend_on, model_tag
+from bookstore.paypal import PAYPAL
+from bookstore.search import search_books
+from bookstore.bestsellers import top_books, top_cards
 from django.contrib.auth.models import User
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import logging
-from random import choice
-import urllib2
 
 # HG mail: http://lillibridgepress.com:2096
 
-# PAYPAL = "https://www.sandbox.paypal.com/cgi-bin/webscr" # sandbox
-PAYPAL = "https://www.paypal.com/cgi-bin/webscr" # real
 
-def get_migrated_object_or_404(model, migrate_values, **kwargs):
-    """equivalent to get_object_or_404 with fallback checks per migrate_values mapping dict"""
-    try:
-        return model.objects.get(**kwargs)
-    except model.DoesNotExist:
-        return get_object_or_404(model, **{k: migrate_values.get(v, v) for k, v in kwargs.items()})
+def get_routed_object_or_404(kind, link, **kwargs):
+    """The object whose current or former link is link, and whether it has moved to another link"""
+    route = routing.resolve(kind, link)
+    if not route:
+        raise Http404
+    object_id, current = route
+    return get_object_or_404(routing.KIND_MODELS[kind], pk=object_id, **kwargs), current != link
+
+def routed_id(kind, link):
+    """The id of the object whose current or former link is link, or 0"""
+    route = routing.resolve(kind, link)
+    return route and route[0] or 0
 
 def get_merged_purchases(user, **kwargs):
-    for merged in MergedUser.objects.filter(accounts=user):
-        return Purchase.objects.filter(customer__in=merged.accounts.all(), **kwargs)
-    return Purchase.objects.filter(customer=user, **kwargs)
+    ids = get_merged_account_ids(user.pk)
+    if len(ids) == 1:
+        return Purchase.objects.filter(customer=user, **kwargs)
+    return Purchase.objects.filter(customer__in=ids, **kwargs)
 
 class Pager:
-    def __init__(self, request, count, pagesize=12):
+    def __init__(self, request, count, pagesize=12, params=None):
         try: page = int(request.REQUEST.get("p", 0))
         except ValueError: page = 0
         try: size = int(request.REQUEST.get("c", pagesize))
@@ -49,23 +62,99 @@ class Pager:
         self.offset = size * page
         self.count = count
         self.pagecount = (count + size - 1) // size
-        self.sizer = sizer = size != pagesize and "&c=%s" % size or ""
+        self.sizer = sizer = (size != pagesize and "&c=%s" % size or "") + (params and "&" + urlencode(params) or "")
         self.slice = slice(self.offset, self.offset + size)
 
         self.next = (page * size + size < count) and ("?p=%s" % (page + 1) + sizer) or ""
         self.prev = (page > 0) and ("?p=%s" % (page - 1) + sizer) or ""
 
+class CursorPager:
+    """Keyset pager: pages through a queryset by (sort column, id) instead of OFFSET.
+
+    Each page is one query for pagesize + 1 rows, however deep it is, and
+    nothing is counted. columns maps the names used with {% sort %} to the
+    column each orders by; the columns must not be null. prev and next
+    carry the first or last row's (id, value) in the url.
+    """
+    cursor = True
+
+    def __init__(self, request, queryset, columns, default, pagesize=50):
+        try: size = int(request.REQUEST.get("c", pagesize))
+        except ValueError: size = pagesize
+        size = min(max(size, 1), pagesize * 4)
+        self.request = request
+        self.size = size
+
+        sort = request.REQUEST.get("sort") or default
+        if sort.lstrip("+-") not in columns:
+            sort = default
+        descending = sort.startswith("-")
+        self.column = column = columns[sort.lstrip("+-")]
+        self.path = column.split("__")
+        field = _related_field(queryset.model, self.path)
+
+        before = request.REQUEST.get("before")
+        backward = bool(before) and not request.REQUEST.get("after")
+        cursor = _parse_cursor(backward and before or request.REQUEST.get("after"), field)
+
+        # walking backward reverses the order, and the rows are put right afterward
+        reverse = descending != backward
+        op = reverse and "lt" or "gt"
+        if reverse:
+            queryset = queryset.order_by("-" + column, "-pk")
+        else:
+            queryset = queryset.order_by(column, "pk")
+        if cursor:
+            pk, value = cursor
+            queryset = queryset.filter(Q(**{column + "__" + op: value}) | Q(**{column: value, "pk__" + op: pk}))
+        items = list(queryset[:size + 1])
+        more = len(items) > size
+        items = items[:size]
+        if backward:
+            items.reverse()
+        self.items = items
+
+        has_prev, has_next = backward and (more, bool(cursor)) or (bool(cursor), more)
+        self.prev = has_prev and items and self._link("before", items[0]) or ""
+        self.next = has_next and items and self._link("after", items[-1]) or ""
+
+    def _link(self, direction, item):
+        value = item
+        for name in self.path:
+            value = getattr(value, name)
+        params = self.request.GET.copy()
+        for name in ("after", "before", "p"):
+            params.pop(name, None)
+        params[direction] = u"%s:%s" % (item.pk, value)
+        return "?" + params.urlencode()
+
+def _related_field(model, path):
+    for name in path[:-1]:
+        model = model._meta.get_field(name).rel.to
+    return model._meta.get_field(path[-1])
+
+def _parse_cursor(cursor, field):
+    """(id, value) from a cursor made by CursorPager, or None if it's missing or damaged"""
+    try:
+        pk, value = cursor.split(":", 1)
+        return int(pk), field.to_python(value)
+    except (AttributeError, ValueError, ValidationError):
+        return None
+
 def _serve_purchase(request, purchase):
     # return the content of the download - serve the file
-    from os import path
     pub = purchase.publication
     book = pub.book
-    data = pub.data
     format = pub.format
-    response = HttpResponse(data, content_type=format.mime)
-    response["Content-Length"] = data.size
-    response['Content-Disposition'] = 'attachment; filename=%s [%s].%s' % (book.title, book.publish_date.year, format.extension)
-    Download.objects.create(purchase=purchase, ipaddress=request.META.get("REMOTE_ADDR"))
+    filename = '%s [%s].%s' % (book.title, book.publish_date.year, format.extension)
+    size = pub.data_size or pub.data.size
+    response = delivery.serve_file(request, pub.data, format.mime, filename,
+        size=size, etag=pub.data_hash or None)
+    if response.status_code in (200, 206):
+        # only the rest of a download already recorded for this file, sent once, is left uncounted
+        offset = delivery.served_from(request, response, size, pub.data_hash)
+        if not (offset and purchase.resume_download(pub.data_hash, offset)):
+            purchase.record_download(request.META.get("REMOTE_ADDR"), pub.data_hash, offset)
     return response
 
 def page_access_denied(request):
@@ -82,7 +171,10 @@ def page_server_error(request):
         webmaster = "webmaster@" + request.get_host()
     return render_to_response("bookstore/page_server_error.html", locals())
 
+@catalog_condition(lambda request: [StorefrontNewsCard.objects.all(), StorefrontAd.objects.all()])
+@cache_anonymous_page
 def storefront(request):
+    depend_on('storefrontnewscard', 'storefrontad', 'sitepage')
     cards = StorefrontNewsCard.objects.filter(visible=True).order_by("display_order")
     all_ads = StorefrontAd.objects.filter(visible=True).order_by("display_order")
     left_ads = all_ads.filter(column="L")
@@ -94,14 +186,10 @@ def storefront(request):
         pass
     return render_to_response("bookstore/storefront.html", locals())
 
-def sitemap(request):
-    published_books = Book.objects.filter(visible=True, publish_date__lte=datetime.now).order_by("-publish_date")
-    upcoming_books = Book.objects.filter(visible=True, publish_date__gt=datetime.now).order_by("publish_date")
-    authors = Person.objects.filter(visible=True, author=True).order_by("lastname", "firstname")
-    genres = Genre.objects.filter(visible=True).order_by("name")
-    site_pages = SitePage.objects.filter(visible=True).order_by("display_order")
-    root = request.build_absolute_uri("/").rstrip("/")
-    return render_to_response("bookstore/sitemap.xml", locals())
+@condition(etag_func=lambda req, shard=None: sitemaps.etag(shard),
+    last_modified_func=lambda req, shard=None: sitemaps.last_modified(shard))
+def sitemap(request, shard=None):
+    return sitemaps.serve(request, shard)
 
 def robots(request):
     return HttpResponse("""Sitemap: %s
@@ -113,15 +201,13 @@ Disallow: /user/
 Disallow: /paypal/
 """ % (request.build_absolute_uri(reverse(sitemap)),), mimetype="text/plain")
 
+@catalog_condition(lambda request, page_link, **kwargs: [])
 def site_page(request, page_link, migrate_url=False):
-    page = get_migrated_object_or_404(SitePage, migrate_pages, link__iexact=page_link, visible=True)
-    if page.link != page_link or migrate_url:
+    page, moved = get_routed_object_or_404('page', page_link, visible=True)
+    if moved or migrate_url:
         return redirect(page, permanent=True)
     return render_to_response("bookstore/site_page.html", locals())
 
-migrate_pages = dict(
-    about="about-us",
-)
     
 def readme(request):
     from os import path
@@ -138,15 +224,8 @@ def site_news(request):
     newsbanners = SiteNewsBanner.objects.filter(visible=True).order_by("display_order")
     return render_to_response("bookstore/site_newsbanner.html", locals())
 
-def choose(qs, choice=choice):
-    if not qs: return None
-    return choice(qs)
-
 def site_picks(request):
-    bestseller = choose(Book.objects.filter(visible=True, bestseller=True))
-    feature = Book.objects.filter(visible=True, feature=True)
-    if bestseller: feature = feature.exclude(link__exact=bestseller.link)
-    feature = choose(feature)
+    bestseller, feature = picks.site_picks()
     return render_to_response("bookstore/site_picks.html", locals())
 
 def author_list(request):
@@ -155,87 +234,82 @@ def author_list(request):
     authors = all_authors[authorpager.slice]
     return render_to_response("bookstore/author_listing.html", locals())
 
+@catalog_condition(lambda request, author_link: [Book.objects.filter(authors=routed_id('author', author_link))])
+@cache_anonymous_page
 def author_detail(request, author_link):
-    author = get_migrated_object_or_404(Person, migrate_authors, link__iexact=author_link, visible=True)
-    if author.link != author_link:
+    author, moved = get_routed_object_or_404('author', author_link, visible=True)
+    if moved:
         return redirect(author, permanent=True)
+    depend_on(model_tag(Person, author.pk), 'book')
     all_books = author.book_set.filter(visible=True, publish_date__lte=datetime.now)
     bookpager = Pager(request, all_books.count())
-    books = all_books[bookpager.slice]
+    books = load_cards(all_books[bookpager.slice])
     link = request.build_absolute_uri()
     return render_to_response("bookstore/author_detail.html", locals())
 
-migrate_authors = {
-    "John_Anderson": "john-anderson",
-    "natasha_bennet": "natasha-bennet",
-    "RE_Blakeslee": "re-blakeslee",
-    "Jordan_Brewer": "jordan-brewer",
-    "DJ_Cockburn": "dj-cockburn",
-    "Joseph_Cox": "joseph-cox",
-    "John_Leahy": "john-leahy",
-    "Ellen_Lett": "ellen-lett",
-    "lydia_nyx": "lydia-nyx",
-    "George_OGorman": "george-ogorman",
-    "George_O%26Gorman": "george-ogorman",
-    "Tom_Olbert": "tom-olbert",
-    "DC_Petterson": "dc-petterson",
-    "DCPetterson": "dc-petterson",
-    "Jaiden_Robert": "jaiden-robert",
-    "Glenn_Stuart": "glenn-stuart",
-    "I_Writer": "i-writer",
-}
 
+@cache_anonymous_page
 def book_list(request):
+    depend_on('book')
     all_books = Book.objects.filter(visible=True, publish_date__lte=datetime.now).order_by("title")
     bookpager = Pager(request, all_books.count())
-    books = all_books[bookpager.slice]
+    books = load_cards(all_books[bookpager.slice])
     return render_to_response("bookstore/book_listing.html", locals())
 
+def search(request):
+    # a trailing space turns off prefix matching of the last word (see SearchIndex.search)
+    query = request.REQUEST.get("q", "").lstrip()
+    ids = query and search_books(query) or []
+    bookpager = Pager(request, len(ids), params=dict(q=query))
+    ids = ids[bookpager.slice]
+    found = Book.objects.in_bulk(ids)
+    books = load_cards([found[id] for id in ids if id in found and found[id].visible])
+    return render_to_response("bookstore/search.html", locals())
+
+@catalog_condition(lambda request, book_link, **kwargs: [Book.objects.filter(pk=routed_id('book', book_link)),
+    (Watermark.objects.filter(name='book_formats'), 'updated')])
+@cache_anonymous_page
 def book_detail(request, book_link, migrate_url=False):
-    book = get_migrated_object_or_404(Book, migrate_books, link__iexact=book_link, visible=True)
-    if book.link != book_link or migrate_url:
+    book, moved = get_routed_object_or_404('book', book_link, visible=True)
+    if moved or migrate_url:
         return redirect(book, permanent=True)
+    depend_on(model_tag(Book, book.pk), 'bookformat', 'bookreseller')
 
     link = request.build_absolute_uri()
     return render_to_response("bookstore/book_detail.html", locals())
 
-migrate_books = dict(
-    Still_Life="still-life",
-    Under_the_Hooked_Cross="under-hooked-cross",
-    The_Body_Servant_of_Aleops="body-servant-aleops",
-    Body_Servant_of_Aleops="body-servant-aleops",
-    venus_loop_tom_olbert="venus-loop",
-    stockwood_street="stockwood-street",
-    The_Last_Ride_ofthe_Reverse_Cowgirls="last-ride-reverse-cowgirls",
-    In_the_Dunes="dunes",
-    The_Zombie_Attached_To_My_Head="zombie-attached-my-head",
-    Sallowed_Blood="sallowed-blood",
-    A_Violin_s_Cry="violins-cry",
-    violin_s_cry="violins-cry",
-    Autumn_s_Spirit="autumns-spirit",
-    The_Last_Guardian="last-guardian",
-    Rune_Song="rune-song",
-    the_lovers="lovers-tale-prehistoric-ain-sakhri-figurine",
-    To_the_Highest_Bidder="highest-bidder",
-    Beautiful_Cruelty="beautiful-cruelty",
-
-    Science_Fiction="science-fiction",
-    Horror_Gothic="horror-and-gothic",
-    magick_occult="magick-and-occult",
-    magic_occult="magick-and-occult",
-    young_adult="young-adult",
-    Myths_Tales="myths-and-tales",
-    myth="myths-and-tales",
-    superhero="Superheroes",
-    free_read="free-read",
+
+BESTSELLER_WINDOWS = (
+    (7, "This Week"),
+    (30, "This Month"),
+    (90, "Last Three Months"),
 )
+GENRE_BESTSELLERS = 4
 
+def _bestseller_window(request):
+    try:
+        window = int(request.GET.get("window", 30))
+    except ValueError:
+        window = 30
+    return window in dict(BESTSELLER_WINDOWS) and window or 30
+
+@catalog_condition(lambda request: [Book.objects.filter(pk__in=[id for id, sales in top_books(_bestseller_window(request))]),
+    (Watermark.objects.filter(name='bestsellers'), 'updated')])
+@cache_anonymous_page
+def bestsellers(request):
+    window = _bestseller_window(request)
+    windows = BESTSELLER_WINDOWS
+    books = top_cards(window)
+    return render_to_response("bookstore/bestsellers.html", locals())
+
+@cache_anonymous_page
 def coming_soon(request):
+    depend_on('book')
     upcoming_books = Book.objects.filter(visible=True, upcoming=True, publish_date__gte=datetime.now).order_by("publish_date")
     bookpager = Pager(request, upcoming_books.count())
     if not bookpager.count:
         return redirect("bookstore.views.storefront", permanent=False)
-    books = upcoming_books[bookpager.slice]
+    books = load_cards(upcoming_books[bookpager.slice])
     return render_to_response("bookstore/coming_soon.html", locals())
 
 def genre_list(request):
@@ -244,28 +318,22 @@ def genre_list(request):
     genres = all_genres[genrepager.slice]
     return render_to_response("bookstore/genre_listing.html", locals())
 
+@catalog_condition(lambda request, genre_link: [Book.objects.filter(genres=routed_id('genre', genre_link)),
+    (Watermark.objects.filter(name='bestsellers'), 'updated')])
+@cache_anonymous_page
 def genre_detail(request, genre_link):
-    genre = get_migrated_object_or_404(Genre, migrate_genres, link__iexact=genre_link, visible=True)
-    if genre.link != genre_link:
+    genre, moved = get_routed_object_or_404('genre', genre_link, visible=True)
+    if moved:
         return redirect(genre, permanent=True)
+    depend_on(model_tag(Genre, genre.pk), 'book')
+    bestsellers = top_cards(30, genre.pk, GENRE_BESTSELLERS)
     all_books = genre.book_set.filter(visible=True, publish_date__lte=datetime.now)
-    upcoming_books = genre.book_set.filter(visible=True, upcoming=True, publish_date__gte=datetime.now).order_by("publish_date")
+    upcoming_books = load_cards(genre.book_set.filter(visible=True, upcoming=True, publish_date__gte=datetime.now).order_by("publish_date"))
     bookpager = Pager(request, all_books.count())
-    books = all_books[bookpager.slice]
+    books = load_cards(all_books[bookpager.slice])
     link = request.build_absolute_uri()
     return render_to_response("bookstore/genre_detail.html", locals())
 
-migrate_genres = dict(
-    Science_Fiction="science-fiction",
-    Horror_Gothic="horror-and-gothic",
-    magick_occult="magick-and-occult",
-    magic_occult="magick-and-occult",
-    Young_Adult="young-adult",
-    Myths_Tales="myths-and-tales",
-    myth="myths-and-tales",
-    superhero="Superheroes",
-    free_reads="free-read",
-)
 
 try:
     import django_openid_auth.views as openid_views
@@ -314,13 +382,14 @@ def purchase_book(request, pub_id):
         raise Http404
 
     book = pub.book
+    book.read_prices()
     status = 'P'
     transaction = 'P'
     free_purchase = book.is_free
     if free_purchase:
         transaction = 'F'
         status = 'R'
-    bookprice = book.price_set.get(currency='USD')
+    bookprice = book.get_price('USD')
     purchase = Purchase.objects.create(transaction=transaction,
                         price=bookprice.quantized,
                         currency=bookprice.currency,
@@ -369,11 +438,21 @@ def download_review(request, purchase_id, key):
     return render_to_response("bookstore/download_limit.html", locals())
     
 
+def _download_purchase(request):
+    """the purchase posted to download_pub, looked up once per request"""
+    try:
+        return request._download_purchase
+    except AttributeError:
+        request._download_purchase = get_object_or_404(
+            Purchase.objects.select_related('publication__book', 'publication__format'),
+            pk=request.POST.get('id'))
+        return request._download_purchase
+
 @require_POST
 @csrf_exempt
-@condition(etag_func=lambda req: get_object_or_404(BookPublication, pk=req.POST.get('pub')).get_etag())
+@condition(etag_func=lambda req: _download_purchase(req).publication.get_etag())
 def download_pub(request):
-    purchase = get_object_or_404(Purchase, pk=request.POST.get('id'))
+    purchase = _download_purchase(request)
     if request.POST.get('key') == purchase.get_key() and purchase.status == 'R' \
         and purchase.is_available_to(request.user):
         return _serve_purchase(request, purchase)
@@ -429,7 +508,8 @@ def user_detail(request, user_id=None):
         if user_id:
             user = User.objects.get(pk=user_id)
     purchases = get_merged_purchases(user).order_by("-date")
-    bookshelf = (purchase.publication for purchase in purchases.filter(status='R'))
+    bookshelf = load_cards(purchase.publication.book for purchase in
+        purchases.filter(status='R').select_related('publication__book'))
     return render_to_response("bookstore/user_detail.html", locals())
 
 @require_POST
@@ -444,41 +524,23 @@ def paypal_ipn(request):
 
         purchase = get_object_or_404(Purchase, pk=purchase_id.strip('rlbp_'))
 
-        # Then verify the parameters from PayPal.
         #params = str(request.raw_post_data)
         params = request.POST.urlencode()
         if not params:
             logging.error("IPN: No parameters")
             return HttpResponseBadRequest()
 
-        confirm_request = urllib2.Request(PAYPAL, params + '&cmd=_notify-validate')
-        confirm_request.add_header("Content-type", "application/x-www-form-urlencoded")
-        confirm_response = urllib2.urlopen(confirm_request)
-        confirm_content = confirm_response.read()
-        if confirm_content != 'VERIFIED':
-            logging.error("IPN: Paypal claims: %s", str(confirm_content)[:40])
-            return HttpResponseForbidden("Unverified")
-
-        # Continue onward if everything is good; record IPN parameters and verify payment amounts.
-        ipn = PaypalIpn.objects.create(purchase=purchase, params=params,
+        # Record the notification and answer right away; `manage.py process_ipn`
+        # verifies it with PayPal and applies it to the purchase.
+        PaypalIpn.objects.create(purchase=purchase, params=params,
             payment=(request.POST.get('payment_gross') or request.POST.get('mc_gross') or request.POST.get('mc_gross_1') or '0').strip('$'),
             currency=request.POST.get('mc_currency', 'USD'),
             payment_status=request.POST.get('payment_status'),
+            txn_id=request.POST.get('txn_id', '')[:50],
+            download_link=request.build_absolute_uri(purchase.get_download_url()),
+            state='Q',
         )
 
-        if purchase.price > ipn.payment:
-            logging.error("IPN: Payment %s smaller than Price %s" % (ipn.payment, purchase.price))
-            return HttpResponseBadRequest("Bad Payment")
-
-        if ipn.payment_status == "Completed":
-            if purchase.status != 'R' and request.POST.get('txn_type') in ('cart', 'express_checkout', 'masspay', 'virtual_terminal', 'web_accept'):
-                purchase.status = 'R'
-                if not purchase.email_sent:
-                    purchase.email_name = request.POST.get('first_name') or request.POST.get('last_name') or 'Lillibridge Press Customer'
-                    purchase.email_address = request.POST.get('payer_email') or purchase.customer.email
-                    purchase.email_link = request.build_absolute_uri(purchase.get_download_url())
-                purchase.save()
-
     except Exception:
         logging.exception("IPN")
         raise
@@ -500,51 +562,83 @@ def staff_allbooks(request):
     if sort:
         books = books.order_by(sort.strip("+"))
 
-    formats = BookFormat.objects.all()
+    formats = list(BookFormat.objects.all())
+    # one query for which formats each book has, rather than one per cell
+    published = set(BookPublication.objects.values_list('book_id', 'format_id'))
+    rows = [(book, [(book.id, format.id) in published and format for format in formats]) for book in books]
     return render_to_response("bookstore/staff_allbooks.html", locals())
 
 @require_staff
 def staff_purchase(request):
     user = request.REQUEST.get('user')
     if user:
-        purchases = get_merged_purchases(User.get(pk=user))
+        purchases = get_merged_purchases(get_object_or_404(User, pk=user))
     else:
         purchases = Purchase.objects.all()
 
     book = request.REQUEST.get('book')
     if book:
-        purchases = purchases.filter(publication__book=Book.get(pk=book))
+        purchases = purchases.filter(publication__book=get_object_or_404(Book, pk=book))
         
     status = request.REQUEST.get('status') or 'RSX'
     purchases = purchases.filter(status__in=status)
     
-    sort = request.REQUEST.get('sort')
-    if sort:
-        purchases = purchases.annotate(downloads=Count('download')).order_by(sort.strip("+"))
-        
-    purchasepager = Pager(request, purchases.count(), pagesize=50)
-    purchases = purchases[purchasepager.slice]
+    purchases = purchases.select_related('publication__book', 'publication__format', 'customer', 'admin')
+    purchasepager = CursorPager(request, purchases, STAFF_PURCHASE_COLUMNS, "-date", pagesize=50)
+    purchases = purchasepager.items
     
     toggle_pending = request.GET.copy()
     toggle_pending["status"] = ['RSX', 'PRSCX'][status == 'RSX']
+    for name in ("after", "before"):
+        toggle_pending.pop(name, None)
     toggle_pending = '?' + toggle_pending.urlencode()
 
     return render_to_response("bookstore/staff_purchases.html", locals())
+
+STAFF_PURCHASE_COLUMNS = {
+    'date': 'date',
+    'transaction': 'transaction',
+    'publication__book': 'publication__book__title',
+    'publication__format': 'publication__format__name',
+    'status': 'status',
+    'price': 'price',
+    'customer': 'customer__first_name',
+    'downloads': 'download_count',
+}
     
 @require_staff
 def staff_purchase_detail(request, purchase_id):
-    purchase = Purchase.objects.get(pk=purchase_id)
+    purchase = get_object_or_404(Purchase, pk=purchase_id)
     downloads = purchase.download_set.all()
 
-    sort = request.REQUEST.get('sort')
-    if sort:
-        downloads = downloads.order_by(sort.strip("+"))
-        
-    downloadpager = Pager(request, downloads.count(), pagesize=50)
-    downloads = downloads[downloadpager.slice]
+    downloadpager = CursorPager(request, downloads, STAFF_DOWNLOAD_COLUMNS, "timestamp", pagesize=50)
+    downloads = downloadpager.items
     
     return render_to_response("bookstore/staff_purchase_detail.html", locals())
+
+STAFF_DOWNLOAD_COLUMNS = {
+    'timestamp': 'timestamp',
+    'ipaddress': 'ipaddress',
+}
     
+@require_staff
+def staff_sales(request):
+    try: days = int(request.REQUEST.get('days', 30))
+    except ValueError: days = 30
+    since = days and (date.today() - timedelta(days - 1)) or None
+    report = reports.sales_report(since)
+    ranges = [(7, "Week"), (30, "Month"), (365, "Year"), (0, "All Time")]
+    return render_to_response("bookstore/staff_sales.html", locals())
+
+@require_staff
+def staff_cache(request):
+    caches = []
+    for name, events in sorted(caching.stats.items()):
+        looked = events.get('hit', 0) + events.get('miss', 0)
+        ratio = looked and "%.1f%%" % (100.0 * events.get('hit', 0) / looked) or ""
+        caches.append((name, sorted(events.items()), ratio))
+    return render_to_response("bookstore/staff_cache.html", locals())
+
 @require_staff
 def staff_review(request):
     if request.POST.get("op") == "review":
@@ -554,7 +648,8 @@ def staff_review(request):
         publication = pub_id and BookPublication.objects.get(pk=pub_id)
         if email and name and publication:
             book = publication.book
-            bookprice = book.price_set.get(currency='USD')
+            book.read_prices()
+            bookprice = book.get_price('USD')
             purchase = Purchase.objects.create(transaction='V',
                                 price=bookprice.quantized,
                                 currency=bookprice.currency,
@@ -571,7 +666,7 @@ def staff_review(request):
             purchase.email_link = request.build_absolute_uri(purchase.get_download_url())
             purchase.save()
             messages.add_message(request, messages.SUCCESS,
-                "Sent review copy of %s (%s) to %s (%s)" % (publication.book.title, publication.format.name, name, email))
+                "Queued review copy of %s (%s) for %s (%s)" % (publication.book.title, publication.format.name, name, email))
             return redirect(staff_review)
         
         if not email: